@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import itertools
+import json
+import os
+import os.path
 import re
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import deque
+from io import BytesIO
 from rtf import ByteStream, flatten, parse, tokenize, walk_left, find_text, filter_control_word, node_range, walk_right, \
-    as_text, dfs_ltr, document_content, match_control_word, split_by, split_end_by, Group, TokenNode, ControlWord, \
-    Separator
+    dfs_ltr, walk_content, is_content_group, match_control_word, Group, TokenNode, ControlWord, Separator, Text, \
+    embedded_object, embedded_objects, walk_materialized, LAZY_DESTINATIONS, SnapshotStore, source_hash, replace, \
+    write_tokens, rewrite, drop_control_words, drop_groups, stream_rows, Error, Limits, LimitExceeded, ParseError
 from enum import Enum
 
 RE_TITULY = r'(?:Bc|Mgr|PhD|Ing)'
@@ -17,6 +28,7 @@ PAT_SP_FORM_PERMISSIVE = re.compile(r'.*2a_SP.*rtf$', re.IGNORECASE)
 PAT_SUBOR = re.compile(r'^{}$'.format(RE_SUBOR))
 PAT_IL_FORM = re.compile('^IL_PREDMETU_{}.rtf$'.format(RE_SUBOR))
 PAT_VPCH_FORM = re.compile('^VPCH_{}.rtf$'.format(RE_SUBOR))
+PAT_SP_NAME = re.compile(r'^SP_\d+(?:[.]\d+)*_' + RE_TITULY + r'(?:_' + RE_TITULY + r')*_(?P<name>[a-zA-Z0-9_-]+)$')
 
 class MessageType(Enum):
     error = 1
@@ -37,42 +49,316 @@ class Message:
         ret += self.message
         return ret
 
+    def to_json(self):
+        return {'message': self.message, 'path': self.path, 'type': self.type.name}
+
+    @classmethod
+    def from_json(cls, record):
+        return cls(record['message'], path=record['path'], type=MessageType[record['type']])
+
+
+class FailFast(Exception):
+    """Raised by Messages.add on an error when fail_fast is set, to stop checking"""
+
 
 class Messages:
-    def __init__(self):
+    """Messages of a run, passed to each sink as they are added.
+
+    Unless keep is false they are also collected in the messages list. flush() ends a batch of messages
+    (those of one form) and lets the sinks write it out. Progress notes go to stderr (unless quiet) and sinks.
+    """
+    def __init__(self, sinks=(), keep=True, quiet=False):
         self.messages = []
+        self.sinks = list(sinks)
+        self.keep = keep
+        self.quiet = quiet
+        self.recent = []  # messages since the last flush
+        self.fail_fast = False
 
     def add(self, *args, **kwargs):
-        self.messages.append(Message(*args, **kwargs))
+        message = Message(*args, **kwargs)
+        if self.keep:
+            self.messages.append(message)
+        self.recent.append(message)
+        for sink in self.sinks:
+            sink.add(message)
+        if self.fail_fast and message.type == MessageType.error:
+            raise FailFast()
+
+    def progress(self, path, text):
+        if not self.quiet:
+            print('{}: {}'.format(path, text), file=sys.stderr)
+        for sink in self.sinks:
+            sink.progress(path, text)
+
+    def flush(self):
+        """Ends the current batch of messages, returns them"""
+        recent = self.recent
+        self.recent = []
+        for sink in self.sinks:
+            sink.flush()
+        return recent
 
     def __str__(self):
         return '\n'.join(str(message) for message in self.messages)
 
 
+class JsonlSink:
+    """Writes each message as a JSON line, flushing the file after each form so that it can be followed live"""
+    def __init__(self, file):
+        self.file = file
+
+    def add(self, message):
+        self.file.write(json.dumps(message.to_json(), ensure_ascii=False) + '\n')
+
+    def progress(self, path, text):
+        self.file.write(json.dumps({'path': path, 'progress': text}, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+
+class ShardResultSink(JsonlSink):
+    """JsonlSink writing the result file of one shard of a run: a header naming the shard, the messages and,
+    once the shard is done, a completion record (see merge_shard_results)"""
+    def __init__(self, file, shard, path):
+        super().__init__(file)
+        self.file.write(json.dumps({'shard': shard[0], 'shards': shard[1], 'path': os.path.abspath(path)}) + '\n')
+
+    def complete(self):
+        self.file.write(json.dumps({'complete': True}) + '\n')
+        self.file.flush()
+
+
+class PrintSink:
+    """Prints messages as they are added"""
+    def __init__(self, file=sys.stdout):
+        self.file = file
+
+    def add(self, message):
+        print(message, file=self.file)
+
+    def progress(self, path, text):
+        pass
+
+    def flush(self):
+        self.file.flush()
+
+
+class Aggregator:
+    """Counts identical messages across paths in bounded memory.
+
+    At most max_groups distinct (type, message) pairs are tracked, each with up to max_paths example paths;
+    messages which do not fit are only counted in dropped.
+    """
+    def __init__(self, max_groups=1000, max_paths=3):
+        self.max_groups = max_groups
+        self.max_paths = max_paths
+        self.groups = {}  # (type, message) -> [count, paths, whether more paths did not fit]
+        self.dropped = 0
+
+    def add(self, message):
+        key = message.type, message.message
+        group = self.groups.get(key)
+        if group is None:
+            if len(self.groups) >= self.max_groups:
+                self.dropped += 1
+                return
+            group = self.groups[key] = [0, [], False]
+        group[0] += 1
+        if message.path is not None and message.path not in group[1]:
+            if len(group[1]) < self.max_paths:
+                group[1].append(message.path)
+            else:
+                group[2] = True
+
+    def progress(self, path, text):
+        pass
+
+    def flush(self):
+        pass
+
+    def summary(self):
+        lines = []
+        for (type, message), (count, paths, more) in sorted(self.groups.items(),
+                                                      key=lambda item: (item[0][0].value, -item[1][0], item[0][1])):
+            line = '[{}] {}x {}'.format(type.name.upper(), count, message)
+            if paths:
+                line += ' ({}{})'.format(', '.join(paths), ', ...' if more else '')
+            lines.append(line)
+        if self.dropped:
+            lines.append('+ {} dalsich sprav'.format(self.dropped))
+        return '\n'.join(lines)
+
+
 def print_iterator(iterator):
     for item in iterator:
         print(item)
         yield item
 
 
-def check_rtf(messages, path, handler=None):
-    with open(path, 'rb') as f:
-        mimetype = magic.from_buffer(f.read(1024), mime=True)
-        if mimetype not in (b'text/rtf', b'application/rtf'):
-            print('{}: Nie je RTF, ale {}'.format(path, mimetype), file=sys.stderr)
-            return
+class NullProfiler:
+    """Profiler used when profiling is off, its phases do nothing"""
+    enabled = False
+
+    def __enter__(self):
+        return {}  # counters are discarded
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def phase(self, path, name):
+        return self
+
+
+null_profiler = NullProfiler()
+
+
+class ProfilePhase:
+    def __init__(self, profiler, path, name):
+        self.profiler = profiler
+        self.path = path
+        self.name = name
+        self.counters = {}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self.counters
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.process_time() - self.cpu_start
+        self.profiler.phases.append(self)
+        return False
+
+
+class Profiler:
+    """Records wall and CPU time and counters (bytes, tokens, nodes) of processing phases of each file"""
+    enabled = True
+
+    def __init__(self):
+        self.phases = []
+        self.origin = time.perf_counter()
+
+    def phase(self, path, name):
+        """Context manager timing a phase, returns a dict for counters of the phase"""
+        return ProfilePhase(self, path, name)
+
+    def summary(self):
+        totals = {}
+        for phase in self.phases:
+            total = totals.setdefault(phase.name, {'count': 0, 'wall': 0, 'cpu': 0, 'counters': {}})
+            total['count'] += 1
+            total['wall'] += phase.wall
+            total['cpu'] += phase.cpu
+            for key, value in phase.counters.items():
+                total['counters'][key] = total['counters'].get(key, 0) + value
+        lines = ['{:<16} {:>7} {:>10} {:>10}  {}'.format('phase', 'count', 'wall [s]', 'cpu [s]', 'counters')]
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]['wall']):
+            counters = ', '.join('{}={}'.format(key, value) for key, value in sorted(total['counters'].items()))
+            lines.append('{:<16} {:>7} {:>10.3f} {:>10.3f}  {}'.format(name, total['count'], total['wall'],
+                                                                      total['cpu'], counters))
+        slowest = sorted(self.phases, key=lambda phase: -phase.wall)[:10]
+        if slowest:
+            lines.append('')
+            lines.append('slowest phases:')
+            for phase in slowest:
+                lines.append('{:>10.3f} s  {} {}'.format(phase.wall, phase.name, phase.path))
+        return '\n'.join(lines)
+
+    def write_trace(self, file):
+        """Writes the phases in the Chrome trace event format (chrome://tracing, Perfetto)"""
+        events = []
+        for phase in self.phases:
+            args = dict(phase.counters)
+            args['path'] = phase.path
+            args['cpu_ms'] = phase.cpu * 1000
+            events.append({'name': phase.name, 'cat': 'ka_autofix', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                           'ts': (phase.start - self.origin) * 1000000, 'dur': phase.wall * 1000000,
+                           'args': args})
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+def error_text(e):
+    """Message text of an rtf.Error"""
+    if isinstance(e, LimitExceeded):
+        return 'subor prekrocil limit {} ({}) na pozicii {}'.format(e.limit, e.value, e.position)
+    if isinstance(e, ParseError):
+        return 'chyba pri parsovani na pozicii {}: {}'.format(e.position, e.description)
+    return str(e)
+
+
+def check_rtf(messages, path, handler=None, options=None):
+    if options is None:
+        options = Options()
+    profiler = options.profiler
+    limits = options.limits
+    with open_form(path, options) as f:
+        size = f.seek(0, os.SEEK_END)
         f.seek(0)
-        bs = ByteStream(f)
-        try:
-            document = parse(tokenize(bs), encoding='cp1250')
-        except:
-            print('{}: Chyba pri parsovani na pozicii {}\n'.format(path, bs.pos), file=sys.stderr)
+        if limits is not None and limits.max_size is not None and size > limits.max_size:
+            messages.add('subor je prilis velky ({} B, limit {} B)'.format(size, limits.max_size), path=path)
             return
-
+        with profiler.phase(path, 'sniff') as counters:
+            mimetype = magic.from_buffer(f.read(1024), mime=True)
+        if isinstance(mimetype, bytes):  # older python-magic returns bytes
+            mimetype = mimetype.decode('ascii')
+        if mimetype not in ('text/rtf', 'application/rtf'):
+            messages.progress(path, 'Nie je RTF, ale {}'.format(mimetype))
+            return
+        f.seek(0)
+        source = f
+        document = None
+        if options.snapshots is not None:
+            with profiler.phase(path, 'snapshot load') as counters:
+                source = f.read()
+                key = source_hash(source, encoding='cp1250', bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS)
+                document = options.snapshots.load(key)
+                counters['bytes'] = len(source)
+        if document is None:
+            bs = ByteStream(source)
+            errors = []
+            try:
+                if profiler.enabled:
+                    # materialize tokens so that tokenizing and parsing are timed separately
+                    with profiler.phase(path, 'tokenize') as counters:
+                        tokens = list(tokenize(bs, bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS,
+                                               limits=limits, errors=errors))
+                        counters['bytes'] = bs.pos
+                        counters['tokens'] = len(tokens)
+                    with profiler.phase(path, 'parse') as counters:
+                        document = parse(tokens, encoding='cp1250', limits=limits, errors=errors)
+                        counters['nodes'] = sum(1 for node in walk_materialized(document))
+                else:
+                    document = parse(tokenize(bs, bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS,
+                                              limits=limits, errors=errors), encoding='cp1250', limits=limits,
+                                     errors=errors)
+            except LimitExceeded as e:
+                messages.add(error_text(e), path=path)
+                return
+            except (MemoryError, RecursionError):
+                messages.add('subor sa neda spracovat v dostupnej pamati', path=path)
+                return
+            # the document was parsed as well as possible, its checks still run after all errors are reported
+            for e in sorted(errors, key=lambda e: e.position):
+                messages.add(error_text(e), path=path)
+            if options.snapshots is not None and not errors:
+                with profiler.phase(path, 'snapshot save'):
+                    options.snapshots.save(key, document)
+
+        reported = len(document.errors)
         if handler:
-            handler(messages, path, document)
+            try:
+                handler(messages, path, document)
+            except (MemoryError, RecursionError):
+                messages.add('subor sa neda spracovat v dostupnej pamati', path=path)
+                return
+        # groups parsed lazily by the checks add their errors later
+        for e in sorted(document.errors[reported:], key=lambda e: e.position):
+            messages.add(error_text(e), path=path)
 
-        print('{}: OK'.format(path), file=sys.stderr)
+        messages.progress(path, 'OK')
 
 
 header_cwords = {'rtf', 'adeflang', 'ansi', 'ansicpg', 'adeff', 'deff', 'uc', 'stshfdbch', 'stshfloch',
@@ -90,19 +376,26 @@ header_cwords = {'rtf', 'adeflang', 'ansi', 'ansicpg', 'adeff', 'deff', 'uc', 's
                 'nocxsptable', 'indrlsweleven', 'noafcnsttbl', 'afelev', 'utinl', 'hwelev', 'spltpgpar',
                 'notcvasp', 'notbrkcnstfrctbl', 'notvatxbx', 'krnprsnet', 'cachedcolbal', 'nouicompat', 'fet'}
 
+ignored_cwords = {'insrsid', 'charrsid', 'pararsid', 'sectrsid', 'tblrsid', 'styrsid', 'delrsid', 'rsid', 'lang',
+                  'langfe', 'langnp', 'langfenp', 'alang', 'noproof'}
+
 ignored_destinations = {'fonttbl', 'colortbl', 'defchp', 'defpap', 'stylesheet', 'listtable', 'listoverridetable',
                       'rsidtbl', 'mmathPr', 'info', 'xmlnstbl', 'themedata', 'header', 'headerl', 'headerr',
                       'headerf', 'footer', 'footerl', 'footerr', 'footerf', 'themedata', 'colorschememapping',
                       'latentstyles', 'datastore'}
 
+# removed by --clean
+noise_cwords = {word.encode('ascii') for word in ignored_cwords if 'rsid' in word}
+noise_destinations = {b'generator', b'rsidtbl'}
+
 
 def is_ignored_node(x):
     if isinstance(x, Group):
         destination, invisible = x.destination
         if destination is not None:
-            return destination.token.word in ignored_destinations
+            return destination.token.word.decode('ascii') in ignored_destinations
     elif isinstance(x, TokenNode) and isinstance(x.token, ControlWord):
-        return x.token.word in ignored_cwords
+        return x.token.word.decode('ascii') in ignored_cwords
     elif isinstance(x, TokenNode) and isinstance(x.token, Separator):
         return True
     return False
@@ -115,10 +408,88 @@ class UserDataType:
 UserData = UserDataType()
 
 
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_cell(text, diacritics=True):
+    """Text of a cell for comparison with the template: no soft hyphens, whitespace (including NBSP)
+    collapsed to single spaces, optionally without diacritics"""
+    text = text.replace('\xad', '').replace('\u2011', '-')
+    text = WHITESPACE.sub(' ', text).strip()
+    if not diacritics:
+        text = ''.join(c for c in unicodedata.normalize('NFD', text) if not unicodedata.combining(c))
+    return text
+
+
+def pattern_masks(pattern):
+    """Bit masks of character positions in pattern for edit_distance"""
+    masks = {}
+    for i, c in enumerate(pattern):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    return masks
+
+
+def edit_distance(pattern, text, limit, masks=None):
+    """Levenshtein distance of pattern and text computed with Myers' bit-parallel algorithm,
+    limit + 1 if it is larger than limit"""
+    m = len(pattern)
+    if abs(m - len(text)) > limit:
+        return limit + 1
+    if m == 0:
+        return len(text)
+    if masks is None:
+        masks = pattern_masks(pattern)
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    vp = full
+    vn = 0
+    score = m
+    remaining = len(text)
+    for c in text:
+        eq = masks.get(c, 0)
+        xv = eq | vn
+        xh = ((((eq & vp) + vp) & full) ^ vp) | eq
+        hp = vn | (~(xh | vp) & full)
+        hn = vp & xh
+        if hp & last:
+            score += 1
+        elif hn & last:
+            score -= 1
+        remaining -= 1
+        if score - remaining > limit:
+            return limit + 1
+        hp = ((hp << 1) | 1) & full
+        hn = (hn << 1) & full
+        vp = hn | (~(xv | hp) & full)
+        vn = hp & xv
+    return score if score <= limit else limit + 1
+
+
 class FormCell:
     def __init__(self, content, section=None):
         self.content = content
         self.section = section
+        if content is not UserData:
+            # the template is normalized once, document cells are normalized by check_formular_sp
+            self.normalized = normalize_cell(content)
+            self.masks = pattern_masks(self.normalized)
+            self.max_distance = len(self.normalized) // 8
+            # section numbers must not differ even by one character
+            if section and self.normalized.startswith(section + ' '):
+                self.prefix = section + ' '
+            else:
+                self.prefix = ''
+
+    def distance(self, value):
+        """Edit distance of a normalized document cell from the template cell, max_distance + 1 if larger"""
+        if self.content is UserData or value == self.normalized:
+            return 0
+        if not value.startswith(self.prefix):
+            return self.max_distance + 1
+        return edit_distance(self.normalized, value, self.max_distance, masks=self.masks)
+
+    def matches(self, value):
+        return self.content is UserData or self.distance(value) <= self.max_distance
 
     def __repr__(self):
         return 'FormCell({!r})'.format(self.content)
@@ -139,14 +510,16 @@ class FormRow:
 
     def match(self, rows, index):
         row = rows[index]
-        matches = True
-        for cell, value in zip(self.content, row):
-            if cell.content is not UserData:
-                if cell.content != value:
-                    matches = False
         if len(self.content) != len(row):
-            matches = False
-        return matches, 1
+            return False, 1
+        for cell, value in zip(self.content, row):
+            if not cell.matches(value):
+                return False, 1
+        return True, 1
+
+    def exact(self, row):
+        """Whether the (matching) row equals the template apart from normalization"""
+        return all(cell.distance(value) == 0 for cell, value in zip(self.content, row))
 
     def __repr__(self):
         return 'FormRow({!r})'.format(self.content)
@@ -163,7 +536,7 @@ class ItemList:
         matches = False
         item_count = 0
         for item in itertools.count(0):
-            if len(rows[index + item]) != self.cols + 1:
+            if index + item >= len(rows) or len(rows[index + item]) != self.cols + 1:
                 break
             if self.numbers and rows[index + item][0] != '{}.'.format(item + 1):
                 break
@@ -172,6 +545,10 @@ class ItemList:
 
         return matches, item_count
 
+    def match_item(self, rows, index):
+        """Whether the row can continue the list"""
+        return len(rows[index]) == self.cols + 1
+
 
 struct_formular_sp = (
     FormRow('I. Základné informácie'),
@@ -440,16 +817,10 @@ struct_formular_sp = (
 )
 
 
-def check_formular_sp(messages, path, document):
-    rows = []
-    for row in split_by(document_content(document.root), match_control_word(b'row')):
-        rows.append([as_text(x) for x in list(split_end_by(row, match_control_word(b'cell')))])
-
+def check_formular_sp(messages, path, rows):
+    """Aligns table rows of the document with struct_formular_sp and reports the differences"""
     form_rows = struct_formular_sp
-
-    i = 0
-    j = 0
-    row_index = 0
+    rows = [[normalize_cell(cell) for cell in row] for row in rows]
 
     table = [[0] * (len(form_rows) + 1) for i in range(len(rows)+1)]
     direction = [[0] * (len(form_rows) + 1) for i in range(len(rows)+1)]
@@ -458,17 +829,16 @@ def check_formular_sp(messages, path, document):
         for j in range(len(form_rows) + 1):
             if i == 0:
                 table[i][j] = j
+                direction[i][j] = 1
             elif j == 0:
                 table[i][j] = i
+                direction[i][j] = 2
             else:
-                have_data = len(rows) > row_index
-                if have_data:
-                    match, skip = form_rows[j-1].match(rows, row_index)
-                    row_index += min(1, skip)
-                else:
-                    match = False
+                match, skip = form_rows[j-1].match(rows, i-1)
                 subst = table[i - 1][j - 1] + (0 if match else 1)
-                delet = table[i - 1][j] + (1 if have_data else 0)
+                # further items of a list do not count as extra rows
+                continues_list = isinstance(form_rows[j-1], ItemList) and form_rows[j-1].match_item(rows, i-1)
+                delet = table[i - 1][j] + (0 if continues_list else 1)
                 inser = table[i][j - 1] + 1
                 value = min(subst, delet, inser)
                 table[i][j] = value
@@ -476,71 +846,835 @@ def check_formular_sp(messages, path, document):
                     direction[i][j] = 0
                 elif value == inser:
                     direction[i][j] = 1
-                elif not have_data:
-                    direction[i][j] = 3
                 else:
                     direction[i][j] = 2
 
+    problems = []
     i, j = len(rows), len(form_rows)
+    while i > 0 or j > 0:
+        if direction[i][j] == 0:
+            if table[i][j] != table[i - 1][j - 1]:
+                problems.append(('riadok {} nezodpoveda sablone ({})'.format(i, form_rows[j-1].section),
+                                 MessageType.error))
+            elif isinstance(form_rows[j-1], FormRow) and not form_rows[j-1].exact(rows[i-1]):
+                problems.append(('riadok {} sa mierne lisi od sablony ({})'.format(i, form_rows[j-1].section),
+                                 MessageType.warning))
+            i -= 1
+            j -= 1
+        elif direction[i][j] == 1:
+            problems.append(('chyba riadok sablony ({})'.format(form_rows[j-1].section), MessageType.error))
+            j -= 1
+        else:
+            if table[i][j] != table[i - 1][j]:
+                problems.append(('nadbytocny riadok {}'.format(i), MessageType.error))
+            i -= 1
+
+    for problem, type in reversed(problems):
+        messages.add(problem, path=path, type=type)
+
+
+def check_formular_sp_stream(messages, path, rows, form_rows=struct_formular_sp):
+    """Matches table rows with form_rows in order while they are being read and reports the first row which
+    does not fit. Unlike check_formular_sp it does not realign after a problem, but it stops reading the
+    document there. Returns True if all of form_rows matched."""
+    rows = iter(rows)
+    seen = []
+
+    def pull():
+        row = next(rows, None)
+        if row is None:
+            return False
+        seen.append([normalize_cell(cell) for cell in row])
+        return True
+
+    index = 0
+    for form_row in form_rows:
+        if index >= len(seen) and not pull():
+            messages.add('chyba riadok sablony ({})'.format(form_row.section), path=path)
+            return False
+        if isinstance(form_row, ItemList):
+            while form_row.match_item(seen, len(seen) - 1) and pull():
+                pass
+        matches, count = form_row.match(seen, index)
+        if not matches:
+            messages.add('riadok {} nezodpoveda sablone ({})'.format(index + 1, form_row.section), path=path)
+            return False
+        if isinstance(form_row, FormRow) and not form_row.exact(seen[index]):
+            messages.add('riadok {} sa mierne lisi od sablony ({})'.format(index + 1, form_row.section),
+                         path=path, type=MessageType.warning)
+        index += count
+    return True
+
+
+# rows of section I, enough to tell an SP form (see --triage)
+triage_formular_sp = tuple(itertools.takewhile(lambda row: not (row.section or '').startswith('II'),
+                                               struct_formular_sp))
+
+
+def stream_check_form(messages, path, form_rows, options):
+    """Runs check_formular_sp_stream on the table rows of a form read as a token stream, without a tree"""
+    with options.profiler.phase(path, 'stream check') as counters:
+        with open_form(path, options) as f:
+            bs = ByteStream(f)
+            try:
+                rows = stream_rows(tokenize(bs, bulk_hex=True, limits=options.limits), encoding='cp1250',
+                                   paragraphs=False)
+                return check_formular_sp_stream(messages, path, rows, form_rows=form_rows)
+            except Error as e:
+                messages.add('chyba pri citani RTF: {}'.format(error_text(e)), path=path)
+                return False
+            finally:
+                counters['bytes'] = bs.pos
+
+
+class Checker:
+    """Base class of checks run on a parsed document by run_checkers.
+
+    All checkers share a single traversal of the document content (see walk_content). A checker receives only
+    the events it declares: nodes of the types listed in node_types, and table rows (lists of cell texts)
+    if wants_rows is set. finish is called after the traversal.
+    """
+    name = None
+    node_types = ()
+    wants_rows = False
+
+    def __init__(self, messages, path, document):
+        self.messages = messages
+        self.path = path
+        self.document = document
 
-    while i > 0 and j > 0:
-        print(direction[i][j])
+    def node(self, node):
+        pass
 
-    print(table)
-    print(direction)
+    def row(self, cells):
+        pass
 
+    def finish(self):
+        pass
 
-def check_formular_sp2(messages, path, document):
-    rows = []
-    for row in split_by(document_content(document.root), match_control_word(b'row')):
-        rows.append([as_text(x) for x in list(split_end_by(row, match_control_word(b'cell')))])
 
-    i = 0
-    while i < len(struct_formular_sp):
-        form_row = struct_formular_sp[i]
-        if isinstance(form_row, FormRow):
-            for j in range(len(rows)):
-                match, skip = form_row.match(rows, j)
-                if match:
-                    break
-            else:
-                # TODO
+checker_classes = []
+
+
+def register_checker(cls):
+    checker_classes.append(cls)
+    return cls
+
+
+def select_checkers(only=None, skip=None):
+    return [cls for cls in checker_classes if (not only or cls.name in only) and not (skip and cls.name in skip)]
+
+
+def timed(timings, name, method):
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            timings[name] = timings.get(name, 0) + time.perf_counter() - start
+    return wrapper
+
+
+def run_checkers(messages, path, document, checkers=None, timings=None, profiler=null_profiler):
+    """Runs checkers (all registered ones by default) in one traversal of the document content.
+
+    If timings is a dict, time spent in each checker is added to it under the checker's name.
+    Returns the checker instances.
+    """
+    if checkers is None:
+        checkers = checker_classes
+    instances = [cls(messages, path, document) for cls in checkers]
+    if timings is not None:
+        for checker in instances:
+            for method in ('node', 'row', 'finish'):
+                setattr(checker, method, timed(timings, checker.name, getattr(checker, method)))
+
+    row_handlers = [checker.row for checker in instances if checker.wants_rows]
+    node_handlers = {}
+    is_cell = match_control_word(b'cell')
+    is_row = match_control_word(b'row')
+    cells = []
+    cell = []
+    row_count = 0
+    with profiler.phase(path, 'traverse') as counters:
+        for node in walk_content(document.root):
+            node_type = node.__class__
+            handlers = node_handlers.get(node_type)
+            if handlers is None:
+                handlers = [checker.node for checker in instances if issubclass(node_type, checker.node_types)]
+                node_handlers[node_type] = handlers
+            for handler in handlers:
+                handler(node)
+
+            if not row_handlers:
+                continue
+            if isinstance(node, Text):
+                cell.append(node.text)
+            elif is_cell(node):
+                cells.append(''.join(cell))
+                cell = []
+            elif is_row(node):
+                for handler in row_handlers:
+                    handler(cells)
+                cells = []
+                cell = []
+                row_count += 1
+
+        if cells:
+            for handler in row_handlers:
+                handler(cells)
+            row_count += 1
+        if profiler.enabled:
+            counters['rows'] = row_count
+
+    for checker in instances:
+        with profiler.phase(path, 'finish {}'.format(checker.name)):
+            checker.finish()
+    return instances
+
+
+@register_checker
+class FormularSPChecker(Checker):
+    """Compares table rows with the template of the SP form"""
+    name = 'formular_sp'
+    wants_rows = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.rows = []
+
+    def row(self, cells):
+        self.rows.append(cells)
+
+    def finish(self):
+        check_formular_sp(self.messages, self.path, self.rows)
+
+
+@register_checker
+class HeaderChecker(Checker):
+    """Reports control words in the document header which are not in header_cwords"""
+    name = 'header'
+    node_types = (TokenNode, Text)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.in_header = True
+        self.unknown = []
+
+    def node(self, node):
+        if not self.in_header:
+            return
+        if isinstance(node, Text) or (isinstance(node.token, ControlWord) and node.token.word in (b'sectd', b'pard')):
+            self.in_header = False
+        elif isinstance(node.token, ControlWord) and node.parent is self.document.root:
+            word = node.token.word.decode('ascii')
+            if word not in header_cwords and word not in self.unknown:
+                self.unknown.append(word)
+
+    def finish(self):
+        if self.unknown:
+            self.messages.add('neocakavane riadiace slova v hlavicke: {}'.format(', '.join(self.unknown)),
+                              path=self.path, type=MessageType.warning)
+
 
+@register_checker
+class HygieneChecker(Checker):
+    """Counts revision and language control words (ignored_cwords) which only bloat the document"""
+    name = 'hygiene'
+    node_types = (TokenNode,)
 
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.count = 0
 
+    def node(self, node):
+        if isinstance(node.token, ControlWord) and is_ignored_node(node):
+            self.count += 1
 
-def process_sp_list_dir(messages, sp_list_dir_path):
+    def finish(self):
+        if self.count:
+            self.messages.add('dokument obsahuje {} nadbytocnych riadiacich slov'.format(self.count),
+                              path=self.path, type=MessageType.info)
+
+
+MAX_EMBEDDED_SIZE = 2 * 1024 * 1024
+
+
+@register_checker
+class EmbeddedChecker(Checker):
+    """Reports oversized embedded pictures and objects"""
+    name = 'embedded'
+    node_types = (Group,)
+
+    def __init__(self, messages, path, document):
+        super().__init__(messages, path, document)
+        self.objects = []
+
+    def node(self, group):
+        if is_content_group(group):
+            obj = embedded_object(group)
+            if obj is not None:
+                self.objects.append(obj)
+        else:
+            # pictures are mostly inside invisible destinations, which the traversal does not enter
+            self.objects.extend(embedded_objects(group))
+
+    def finish(self):
+        for obj in self.objects:
+            if obj.size > MAX_EMBEDDED_SIZE:
+                self.messages.add('vlozeny objekt ({}) na pozicii {} ma {:.1f} MB'.format(
+                    obj.format or obj.kind, obj.pos, obj.size / 1024 / 1024), path=self.path, type=MessageType.warning)
+
+
+class SPKeysChecker(Checker):
+    """Extracts the FormKeys of an SP form for the cross checks of its directory (not a registered check)"""
+    name = 'sp_keys'
+    wants_rows = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.rows = []
+        self.keys = None
+
+    def row(self, cells):
+        self.rows.append(cells)
+
+    def finish(self):
+        self.keys = sp_form_keys(self.path, self.rows)
+
+
+class Journal:
+    """Append-only JSON lines record of checked forms (path, mtime, size and messages) for resuming a run"""
+    def __init__(self, path, resume=False):
+        self.done = {}
+        newline = ''
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                line = ''
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # cut short by a crash
+                    self.done[record['path']] = record
+                if line and not line.endswith('\n'):
+                    newline = '\n'
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self.file.write(newline)
+
+    def replay(self, messages, path):
+        """Adds stored messages of an unchanged form already checked, returns whether there were any"""
+        stat = os.stat(path)
+        record = self.done.get(os.path.abspath(path))
+        if record is None or record['mtime'] != stat.st_mtime_ns or record['size'] != stat.st_size:
+            return False
+        for message in record['messages']:
+            messages.add(message['message'], path=message['path'], type=MessageType[message['type']])
+        return True
+
+    def record(self, path, messages):
+        stat = os.stat(path)
+        record = {'path': os.path.abspath(path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                  'messages': [message.to_json() for message in messages]}
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Prefetcher:
+    """Reads forms ahead in background threads, so that reading the next ones overlaps checking the current one.
+
+    Paths are scheduled in the order they will be opened. Read files are held in memory until released.
+    A worker reserves the size of a file before reading it and waits while the reservation would exceed
+    the budget; files larger than the budget are left to be read when opened.
+    """
+    def __init__(self, workers=2, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self.queue = deque()
+        self.known = set()  # scheduled, being read or read
+        self.loading = set()
+        self.waiting = set()  # loading, but waiting for budget
+        self.data = {}
+        self.held = 0  # bytes read or reserved
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def schedule(self, paths):
+        with self.condition:
+            for path in paths:
+                if path not in self.known:
+                    self.known.add(path)
+                    self.queue.append(path)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self.queue:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                path = self.queue.popleft()
+                self.loading.add(path)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None  # reported when the form is opened
+            with self.condition:
+                if size is not None and size <= self.budget:
+                    self.waiting.add(path)
+                    self.condition.notify_all()
+                    while (not self.closed and path in self.waiting and path in self.known and
+                           self.held + size > self.budget):
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    if path in self.waiting and path in self.known:
+                        self.held += size
+                    else:
+                        size = None  # opened or released meanwhile
+                    self.waiting.discard(path)
+                else:
+                    size = None
+                if size is None:
+                    self.loading.discard(path)
+                    self.condition.notify_all()
+                    continue
+            data = None
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read(size + 1)
+                if len(data) > size:
+                    data = None  # grew since its size was reserved, read when opened
+            except OSError:
+                pass
+            with self.condition:
+                self.loading.discard(path)
+                self.held -= size
+                if data is not None and path in self.known:
+                    self.data[path] = data
+                    self.held += len(data)
+                self.condition.notify_all()
+
+    def open(self, path):
+        """Returns a binary file with the content of path, prefetched if possible"""
+        with self.condition:
+            if path in self.queue:
+                self.queue.remove(path)  # not started yet, faster to read it now
+            while path in self.loading:
+                if path in self.waiting:
+                    # waiting for budget, read it now instead
+                    self.waiting.discard(path)
+                    self.condition.notify_all()
+                    break
+                self.condition.wait()
+            data = self.data.get(path)
+        if data is None:
+            return open(path, 'rb')
+        return BytesIO(data)
+
+    def release(self, paths):
+        """Forgets content of paths which will not be opened again"""
+        with self.condition:
+            for path in paths:
+                self.known.discard(path)
+                if path in self.queue:
+                    self.queue.remove(path)
+                data = self.data.pop(path, None)
+                if data is not None:
+                    self.held -= len(data)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+def open_form(path, options):
+    if options.prefetcher is not None:
+        return options.prefetcher.open(path)
+    return open(path, 'rb')
+
+
+# budgets of a single form, see rtf.Limits; depth is kept well below the recursion limit of tree walks
+default_limits = Limits(max_size=64 * 1024 * 1024, max_depth=200, max_tokens=50 * 1000 * 1000, max_seconds=120,
+                        max_unicode_skip=8)
+
+
+class Options:
+    """Settings of a validation run passed down through the process_* functions"""
+    def __init__(self, checkers=None, timings=None, profiler=null_profiler, snapshots=None, replacements=None,
+                 fix_output=None, clean=False, fail_fast=None, triage=False, limits=default_limits, journal=None,
+                 cross_checks=True, prefetcher=None, shard=None):
+        self.checkers = checkers
+        self.timings = timings
+        self.profiler = profiler
+        self.snapshots = snapshots
+        self.replacements = replacements
+        self.fix_output = fix_output
+        self.clean = clean
+        self.fail_fast = fail_fast  # None, 'file' or 'tree'
+        self.triage = triage
+        self.limits = limits
+        self.journal = journal
+        self.cross_checks = cross_checks
+        self.prefetcher = prefetcher
+        self.shard = shard  # (index, count) of the study programs to check, see shard_of
+
+
+def fix_output_path(messages, path, options):
+    """Returns path of the fixed copy of a form, None if it would overwrite the form itself"""
+    output_path = os.path.join(options.fix_output, os.path.basename(path))
+    if os.path.abspath(output_path) == os.path.abspath(path):
+        messages.add('opraveny subor by prepisal povodny, zvolte iny adresar', path=path)
+        return None
+    return output_path
+
+
+def clean_form(messages, path, options):
+    """Writes a copy of the form without revision ids and generator info, working on tokens only"""
+    output_path = fix_output_path(messages, path, options)
+    if output_path is None:
+        return
+    stages = [lambda tokens: drop_groups(tokens, noise_destinations),
+              lambda tokens: drop_control_words(tokens, noise_cwords)]
+    with options.profiler.phase(path, 'clean') as counters:
+        with open(path, 'rb') as source, open(output_path, 'wb') as f:
+            try:
+                counters['bytes'] = rewrite(source, f, stages, limits=options.limits)
+            except Error as e:
+                messages.add('subor sa neda vycistit: {}'.format(error_text(e)), path=path)
+
+
+def fix_document(messages, path, document, options):
+    """Applies options.replacements to the document and writes it to options.fix_output if anything changed"""
+    with options.profiler.phase(path, 'replace') as counters:
+        count = replace(document, options.replacements)
+        counters['replacements'] = count
+    if count == 0:
+        return
+    output_path = fix_output_path(messages, path, options)
+    if output_path is None:
+        return
+    with options.profiler.phase(path, 'write') as counters:
+        with open(output_path, 'wb') as f:
+            counters['bytes'] = write_tokens(flatten(document), f)
+    messages.add('nahradenych {} vyskytov, opraveny subor {}'.format(count, output_path), path=path,
+                 type=MessageType.info)
+
+
+TITLE_WORDS = {'prof', 'doc', 'dr', 'rndr', 'phdr', 'paeddr', 'mudr', 'judr', 'ing', 'mgr', 'bc', 'phd', 'csc',
+               'drsc', 'artd', 'art', 'h', 'c', 'arch', 'doctor', 'honoris', 'causa'}
+
+
+def join_key(text):
+    """Key under which names from different forms are compared: lowercase, no diacritics or punctuation"""
+    return re.sub(r'[^a-z0-9]+', ' ', normalize_cell(text, diacritics=False).lower()).strip()
+
+
+def person_key(name):
+    """join_key of a person's name without academic titles and independent of the order of names"""
+    return ' '.join(sorted(word for word in join_key(name).split() if word not in TITLE_WORDS))
+
+
+def labelled_value(row):
+    """Returns (label, value) of a row with a label cell and a value cell or a single 'label: value' cell"""
+    if len(row) >= 2:
+        return normalize_cell(row[0]), next((normalize_cell(cell) for cell in row[1:] if cell.strip()), '')
+    label, colon, value = normalize_cell(row[0]).partition(':') if row else ('', '', '')
+    return label.strip(), value.strip()
+
+
+class FormKeys:
+    """Names extracted from one form for cross-document checks, keyed by join_key/person_key.
+
+    required holds the keys of teachers who must have a VPCH form.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.program = None
+        self.courses = {}
+        self.teachers = {}
+        self.required = set()
+
+    def add_course(self, name):
+        if join_key(name):
+            self.courses.setdefault(join_key(name), name)
+
+    def add_teacher(self, name, required=False):
+        if person_key(name):
+            self.teachers.setdefault(person_key(name), name)
+            if required:
+                self.required.add(person_key(name))
+
+
+# header row and item list of the II.17 table of courses and teachers; items start with a number column
+course_table_header, course_table_items = next(
+    (row, struct_formular_sp[i + 1]) for i, row in enumerate(struct_formular_sp)
+    if row.section == 'II.17' and isinstance(struct_formular_sp[i + 1], ItemList))
+COURSE_NAME, COURSE_TEACHER, COURSE_TEACHER_FUNCTION = 1, 2, 3
+
+# functions of teachers required to have a VPCH form (professors and docents, also guest ones)
+RE_VPCH_FUNCTION = re.compile(r'\b(?:prof|doc)')
+
+
+def sp_form_keys(path, rows):
+    """Program name (I.5), courses and their teachers (II.17) and guarantors (II.18) of an SP form"""
+    keys = FormKeys(path)
+    in_courses = False
+    for row in rows:
+        row = [normalize_cell(cell) for cell in row]
+        label = row[0] if row else ''
+        if label.startswith('I.5 ') and len(row) > 1:
+            keys.program = row[1]
+        elif course_table_header.match([row], 0)[0]:
+            in_courses = True
+        elif in_courses and course_table_items.match_item([row], 0):
+            keys.add_course(row[COURSE_NAME])
+            keys.add_teacher(row[COURSE_TEACHER],
+                             required=bool(RE_VPCH_FUNCTION.search(join_key(row[COURSE_TEACHER_FUNCTION]))))
+        else:
+            in_courses = False
+        if label == 'Priezvisko a meno' and len(row) > 1:
+            keys.add_teacher(row[1], required=True)  # guarantors of the program
+    return keys
+
+
+def il_form_keys(path, rows):
+    """Course name of an IL form"""
+    keys = FormKeys(path)
+    for row in rows:
+        label, value = labelled_value(row)
+        if join_key(label).startswith('nazov predmetu'):
+            keys.add_course(value)
+            break
+    return keys
+
+
+def vpch_form_keys(path, rows):
+    """Name of the person described by a VPCH form"""
+    keys = FormKeys(path)
+    surname = given_name = None
+    for row in rows:
+        label, value = labelled_value(row)
+        label = join_key(label)
+        if label.startswith('priezvisko') and 'meno' in label:
+            keys.add_teacher(value)
+            break
+        elif label.startswith('priezvisko'):
+            surname = value
+        elif label.startswith('meno'):
+            given_name = value
+        if surname and given_name:
+            keys.add_teacher(surname + ' ' + given_name)
+            break
+    return keys
+
+
+def extract_form_keys(path, extractor, options):
+    """Reads the table rows of a form as a token stream and extracts its keys, None if it cannot be read"""
+    with options.profiler.phase(path, 'extract') as counters:
+        with open_form(path, options) as f:
+            bs = ByteStream(f)
+            try:
+                rows = stream_rows(tokenize(bs, bulk_hex=True, limits=options.limits), encoding='cp1250',
+                                   paragraphs=False)
+                return extractor(path, rows)
+            except Error:
+                return None  # reported by the checks of the form
+            finally:
+                counters['bytes'] = bs.pos
+
+
+def check_sp_dir_consistency(messages, sp_dir_path, nazov_sp, sp_keys, il_keys, vpch_keys):
+    """Compares the SP form with the IL and VPCH forms of its directory by joins on their keys"""
+    if nazov_sp is not None and sp_keys.program is not None:
+        m = PAT_SP_NAME.match(nazov_sp)
+        if m and join_key(m.group('name')) != join_key(sp_keys.program):
+            messages.add('nazov studijneho programu ({}) nesuhlasi s nazvom adresara'.format(sp_keys.program),
+                         path=sp_keys.path)
+
+    il_index = {}
+    for keys in il_keys:
+        if not keys.courses:
+            messages.add('v informacnom liste sa nenasiel nazov predmetu', path=keys.path,
+                         type=MessageType.warning)
+        for key in keys.courses:
+            il_index.setdefault(key, keys)
+    for key, name in sp_keys.courses.items():
+        if key not in il_index:
+            messages.add('predmet {} nema informacny list'.format(name), path=sp_keys.path)
+    for key, keys in il_index.items():
+        if key not in sp_keys.courses:
+            messages.add('predmet {} sa v SP nenachadza'.format(keys.courses[key]), path=keys.path,
+                         type=MessageType.warning)
+
+    vpch_index = {}
+    for keys in vpch_keys:
+        if not keys.teachers:
+            messages.add('vo VPCH sa nenaslo meno', path=keys.path, type=MessageType.warning)
+        for key in keys.teachers:
+            vpch_index.setdefault(key, keys)
+    for key, name in sp_keys.teachers.items():
+        if key in sp_keys.required and key not in vpch_index:
+            messages.add('ucitel {} nema VPCH'.format(name), path=sp_keys.path)
+    for key, keys in vpch_index.items():
+        if key not in sp_keys.teachers:
+            messages.add('ucitel {} sa v SP nenachadza'.format(keys.teachers[key]), path=keys.path,
+                         type=MessageType.warning)
+
+
+def process_sp_list_dir(messages, sp_list_dir_path, options=None):
     """Spracovava adresare s nazvom 3a_SP_ziadosti"""
-    for name in os.listdir(sp_list_dir_path):
-        path = os.path.join(sp_list_dir_path, name)
+    if options is None:
+        options = Options()
+    names = os.listdir(sp_list_dir_path)
+    if options.shard is not None:
+        index, count = options.shard
+        names = [name for name in names if shard_of(name, count) == index]
+    dir_paths = [os.path.join(sp_list_dir_path, name) for name in names]
+    listings = {}  # names in directories listed ahead for the prefetcher
+    for i, (name, path) in enumerate(zip(names, dir_paths)):
         if not os.path.isdir(path):
             messages.add('nie je adresar', path=path)
+            messages.flush()
             continue
         if not PAT_SP_DIR.match(name):
             messages.add('nevyhovuje formatu nazvu adresara pre studijny program', path=path)
-        process_sp_dir(messages, path, nazov_sp=name)
-
-
-def process_sp_dir(messages, sp_dir_path, nazov_sp=None):
-    """Spracovava adresare studijneho programu"""
+        if options.prefetcher is not None:
+            # the forms of this directory first, then those of the next one while this one is checked
+            for dir_path in dir_paths[i:i + 2]:
+                if dir_path not in listings and os.path.isdir(dir_path):
+                    listings[dir_path] = os.listdir(dir_path)
+                    options.prefetcher.schedule(sp_dir_form_paths(dir_path, listings[dir_path], options))
+        process_sp_dir(messages, path, nazov_sp=name, options=options, names=listings.pop(path, None))
+
+
+def shard_of(name, count):
+    """Returns the shard (0 to count - 1) a study program directory belongs to, the same on every machine"""
+    return zlib.crc32(name.encode('utf-8')) % count
+
+
+def read_shard_result(path):
+    """Reads a result file of one shard, returns its (index, count, checked path, messages, complete)"""
+    index = count = root = None
+    messages = []
+    complete = False
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # cut short by a crash
+            if 'shard' in record:
+                index, count, root = record['shard'], record['shards'], record.get('path')
+            elif 'message' in record:
+                messages.append(Message.from_json(record))
+            elif record.get('complete'):
+                complete = True
+    return index, count, root, messages, complete
+
+
+def merge_shard_results(paths):
+    """Combines result files of all shards of a run into Messages ordered by path, returns them with a list of
+    problems (missing or incomplete shards, shards of different runs)"""
+    problems = []
+    shards = {}
+    counts = set()
+    roots = set()
+    for path in paths:
+        index, count, root, shard_messages, complete = read_shard_result(path)
+        if index is None:
+            problems.append('{}: nie je vysledok shardu'.format(path))
+            continue
+        if not complete:
+            problems.append('{}: shard {}/{} nebol dokonceny'.format(path, index, count))
+        if index in shards:
+            problems.append('{}: shard {}/{} je zadany viackrat'.format(path, index, count))
+        counts.add(count)
+        roots.add(root)
+        shards[index] = shard_messages
+    if len(counts) > 1:
+        problems.append('vysledky su z behov s roznym poctom shardov ({})'.format(
+            ', '.join(str(count) for count in sorted(counts))))
+    if len(roots) > 1:
+        problems.append('vysledky su z behov pre rozne adresare ({})'.format(
+            ', '.join(str(root) for root in sorted(roots, key=str))))
+    for count in counts:
+        for index in range(count):
+            if index not in shards:
+                problems.append('chyba vysledok shardu {}/{}'.format(index, count))
+    merged = Messages(quiet=True)
+    # stable sort, messages of one path keep their order
+    merged.messages = sorted(itertools.chain.from_iterable(shards[index] for index in sorted(shards)),
+                             key=lambda message: message.path or '')
+    return merged, problems
+
+
+def process_sp_dir(messages, sp_dir_path, nazov_sp=None, options=None, names=None):
+    """Spracovava adresare studijneho programu (names su mena suborov v nom, ak uz boli nacitane)"""
+    if options is None:
+        options = Options()
+    if names is None:
+        with options.profiler.phase(sp_dir_path, 'listdir'):
+            names = os.listdir(sp_dir_path)
+    if options.prefetcher is not None:
+        form_paths = sp_dir_form_paths(sp_dir_path, names, options)
+        options.prefetcher.schedule(form_paths)
+    try:
+        process_sp_dir_files(messages, sp_dir_path, names, nazov_sp, options)
+    finally:
+        if options.prefetcher is not None:
+            options.prefetcher.release(form_paths)
+
+
+def sp_dir_form_paths(sp_dir_path, names, options):
+    """Returns paths of the forms process_sp_dir reads, in the order it reads them"""
+    cross_checks = options.cross_checks and not options.triage
+    return [os.path.join(sp_dir_path, name) for name in names
+            if PAT_SP_FORM_PERMISSIVE.match(name) or cross_checks and (PAT_IL_FORM.match(name) or
+                                                                       PAT_VPCH_FORM.match(name))]
+
+
+def process_sp_dir_files(messages, sp_dir_path, names, nazov_sp, options):
     pocet_formularov_sp = 0
     pocet_formularov_vpch = 0
     pocet_formularov_il = 0
-    for name in os.listdir(sp_dir_path):
+    cross_checks = options.cross_checks and not options.triage
+    sp_keys = None
+    il_keys = []
+    vpch_keys = []
+    for name in names:
         path = os.path.join(sp_dir_path, name)
         if PAT_SP_FORM_PERMISSIVE.match(name):
-            process_sp_form(messages, path, nazov_sp=nazov_sp)
             pocet_formularov_sp += 1
+            extract_keys = cross_checks and pocet_formularov_sp == 1
+            keys = process_sp_form(messages, path, nazov_sp=nazov_sp, options=options, extract_keys=extract_keys)
+            if extract_keys:
+                # a form replayed from the journal or stopped by --fail-fast was not parsed
+                sp_keys = keys if keys is not None else extract_form_keys(path, sp_form_keys, options)
         else:
             if PAT_IL_FORM.match(name):
                 pocet_formularov_il += 1
+                if cross_checks:
+                    il_keys.append(extract_form_keys(path, il_form_keys, options))
             elif PAT_VPCH_FORM.match(name):
                 pocet_formularov_vpch += 1
+                if cross_checks:
+                    vpch_keys.append(extract_form_keys(path, vpch_form_keys, options))
             process_generic_file(messages, path)
 
     if pocet_formularov_sp == 0:
         messages.add('adresar neobsahuje formular SP', path=sp_dir_path)
-    else:
+    elif pocet_formularov_sp > 1:
         messages.add('v adresari sa nachadza viac formularov SP', path=sp_dir_path)
 
     if pocet_formularov_il == 0:
@@ -549,20 +1683,76 @@ def process_sp_dir(messages, sp_dir_path, nazov_sp=None):
     if pocet_formularov_vpch == 0:
         messages.add('adresar neobsahuje formular VPCH', path=sp_dir_path)
 
-
-def process_sp_form(messages, sp_form_path, nazov_sp=None):
-    name = os.path.basename(sp_form_path)
-    if not PAT_SP_FORM.match(name):
-        messages.add('nazov formulara SP nevyhovuje formatu', path=sp_form_path)
-    if nazov_sp is not None and name != '2a_{}_formular.rtf':
-        messages.add('nazov formulara SP nesuhlasi s nazvom adresara', path=sp_form_path)
-    check_rtf(messages, sp_form_path, check_formular_sp)
+    if sp_keys is not None:
+        if nazov_sp is None:
+            nazov_sp = os.path.basename(os.path.abspath(sp_dir_path))
+        check_sp_dir_consistency(messages, sp_dir_path, nazov_sp, sp_keys,
+                                 [keys for keys in il_keys if keys is not None],
+                                 [keys for keys in vpch_keys if keys is not None])
+    messages.flush()
+
+
+def process_sp_form(messages, sp_form_path, nazov_sp=None, options=None, extract_keys=False):
+    """Checks an SP form. With extract_keys, returns its FormKeys if the form was parsed, otherwise None."""
+    if options is None:
+        options = Options()
+    messages.flush()
+    if options.journal is not None and options.journal.replay(messages, sp_form_path):
+        messages.flush()
+        return None
+    keys = None
+    completed = False
+    fail_fast = messages.fail_fast
+    messages.fail_fast = options.fail_fast is not None
+    try:
+        name = os.path.basename(sp_form_path)
+        if not PAT_SP_FORM.match(name):
+            messages.add('nazov formulara SP nevyhovuje formatu', path=sp_form_path)
+        if nazov_sp is not None and name != '2a_{}_formular.rtf'.format(nazov_sp):
+            messages.add('nazov formulara SP nesuhlasi s nazvom adresara', path=sp_form_path)
+
+        if options.triage:
+            stream_check_form(messages, sp_form_path, triage_formular_sp, options)
+        else:
+            checkers = options.checkers
+            if options.fail_fast is not None:
+                # find a broken table without reading the rest of the file; an error there raises FailFast,
+                # so a table which got past it needs no second check (and its warnings are not repeated)
+                stream_check_form(messages, sp_form_path, struct_formular_sp, options)
+                checkers = [cls for cls in checkers or checker_classes if cls is not FormularSPChecker]
+            if extract_keys:
+                checkers = list(checkers or checker_classes) + [SPKeysChecker]
+
+            def handler(messages, path, document):
+                nonlocal keys
+                instances = run_checkers(messages, path, document, checkers=checkers, timings=options.timings,
+                                         profiler=options.profiler)
+                if extract_keys:
+                    keys = instances[-1].keys
+                if options.replacements:
+                    fix_document(messages, path, document, options)
+
+            if options.clean:
+                clean_form(messages, sp_form_path, options)
+            check_rtf(messages, sp_form_path, handler, options=options)
+        completed = True
+    except FailFast:
+        completed = True
+        if options.fail_fast == 'tree':
+            raise
+    finally:
+        messages.fail_fast = fail_fast
+        form_messages = messages.flush()
+        if completed and options.journal is not None:
+            options.journal.record(sp_form_path, form_messages)
+    return keys
 
 
 def process_generic_file(messages, path):
     name = os.path.basename(path)
     if not PAT_SUBOR.match(name):
         messages.add('nazov suboru obsahuje nepovolene znaky', path=path)
+    messages.flush()
 
 
 def guess_path_type(path):
@@ -579,30 +1769,142 @@ def guess_path_type(path):
     return None
 
 
-def process_path(messages, path, type):
-    if type == 'sp_list':
-        process_sp_list_dir(messages, path)
-    elif type == 'sp':
-        process_sp_dir(messages, path)
-    elif type == 'sp_form':
-        process_sp_form(messages, path)
-    else:
-        raise ValueError('Unknown path type')
+def process_path(messages, path, type, options=None):
+    if options is None:
+        options = Options()
+    messages.fail_fast = options.fail_fast == 'tree'
+    try:
+        if type == 'sp_list':
+            process_sp_list_dir(messages, path, options=options)
+        elif type == 'sp':
+            process_sp_dir(messages, path, options=options)
+        elif type == 'sp_form':
+            process_sp_form(messages, path, options=options)
+        else:
+            raise ValueError('Unknown path type')
+    except FailFast:
+        pass
+    finally:
+        messages.fail_fast = False
+        messages.flush()
+
 
+if __name__ == '__main__' and sys.argv[1:2] == ['merge']:
+    import argparse
 
-if __name__ == '__main__':
-    import sys
+    parser = argparse.ArgumentParser(prog='ka_autofix.py merge',
+                                     description='combine result files of --shard runs into one report')
+    parser.add_argument('results', nargs='+')
+    args = parser.parse_args(sys.argv[2:])
+    messages, problems = merge_shard_results(args.results)
+    for problem in problems:
+        sys.stderr.write(problem + '\n')
+    print(messages)
+    exit(1 if problems else 0)
+
+elif __name__ == '__main__':
     import argparse
-    import os
-    import os.path
     import magic
 
+    checker_names = [cls.name for cls in checker_classes]
     parser = argparse.ArgumentParser()
     parser.add_argument('path')
     parser.add_argument('--type', choices=('sp', 'sp_list', 'sp_form'))
+    parser.add_argument('--only', action='append', choices=checker_names, help='run only this check (repeatable)')
+    parser.add_argument('--skip', action='append', choices=checker_names, help='skip this check (repeatable)')
+    parser.add_argument('--timing', action='store_true', help='print time spent in each check')
+    parser.add_argument('--profile', metavar='TRACE_FILE',
+                        help='print time spent in each phase and write a Chrome trace of them to TRACE_FILE')
+    parser.add_argument('--snapshots', metavar='DIR',
+                        help='reuse parsed documents stored in DIR, store newly parsed ones there')
+    parser.add_argument('--replace', nargs=2, action='append', metavar=('OLD', 'NEW'),
+                        help='replace text OLD by NEW, also across formatting changes (repeatable)')
+    parser.add_argument('--clean', action='store_true',
+                        help='write copies of forms without revision ids and generator info')
+    parser.add_argument('--fix-output', metavar='DIR', help='directory for forms written by --replace or --clean')
+    parser.add_argument('--fail-fast', choices=('file', 'tree'),
+                        help='stop at the first error in each form (file) or at the first error at all (tree)')
+    parser.add_argument('--triage', action='store_true',
+                        help='only check that forms start with the section I table, reading as little as needed')
+    parser.add_argument('--max-size', type=int, metavar='MB', default=default_limits.max_size // 2 ** 20,
+                        help='skip forms larger than this')
+    parser.add_argument('--max-depth', type=int, default=default_limits.max_depth,
+                        help='maximum nesting of groups in a form')
+    parser.add_argument('--max-seconds', type=float, default=default_limits.max_seconds,
+                        help='maximum time spent reading one form')
+    parser.add_argument('--max-memory', type=int, metavar='MB',
+                        help='limit memory of the whole run, a form which does not fit is reported and skipped')
+    parser.add_argument('--journal', metavar='FILE', help='record results of checked forms in FILE as they finish')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip unchanged forms recorded in the --journal file and report their stored results')
+    parser.add_argument('--no-cross-checks', dest='cross_checks', action='store_false',
+                        help='do not compare the SP form with the IL and VPCH forms of its directory')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='THREADS',
+                        help='read upcoming forms in this many background threads while checking the current one')
+    parser.add_argument('--prefetch-budget', type=int, default=64, metavar='MB',
+                        help='memory for forms read ahead by --prefetch')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='check only the I-th of N parts of the study programs (I from 0), needs --jsonl FILE '
+                             'for results of the part, combined by "ka_autofix.py merge FILE..."')
+    parser.add_argument('--jsonl', metavar='FILE', help='write messages and progress to FILE (- for stdout) as JSON '
+                                                        'lines while checking, flushed after each form')
+    parser.add_argument('--stream', action='store_true', help='print messages as they are found, not at the end')
+    parser.add_argument('--summary', action='store_true',
+                        help='print identical messages once with their count instead of all of them')
     args = parser.parse_args()
-
-    messages = Messages()
+    if args.resume and args.journal is None:
+        parser.error('--resume requires --journal')
+    if (args.replace or args.clean) and args.fix_output is None:
+        parser.error('--replace and --clean require --fix-output')
+    if args.replace and args.clean:
+        parser.error('--replace and --clean cannot be combined')
+    if args.jsonl == '-' and (args.stream or args.summary):
+        parser.error('--jsonl - writes JSON lines to stdout, it cannot be combined with --stream or --summary')
+    shard = None
+    if args.shard is not None:
+        m = re.match(r'^(\d+)/(\d+)$', args.shard)
+        if not m or not int(m.group(1)) < int(m.group(2)):
+            parser.error('--shard must be I/N with 0 <= I < N')
+        shard = int(m.group(1)), int(m.group(2))
+        if args.jsonl is None or args.jsonl == '-':
+            parser.error('--shard requires --jsonl FILE')
+
+    options = Options(checkers=select_checkers(only=args.only, skip=args.skip),
+                      timings={} if args.timing else None,
+                      profiler=Profiler() if args.profile else null_profiler,
+                      snapshots=SnapshotStore(args.snapshots) if args.snapshots else None,
+                      replacements=args.replace, fix_output=args.fix_output, clean=args.clean,
+                      fail_fast=args.fail_fast, triage=args.triage,
+                      limits=Limits(max_size=args.max_size * 2 ** 20, max_depth=args.max_depth,
+                                    max_tokens=default_limits.max_tokens, max_seconds=args.max_seconds,
+                                    max_unicode_skip=default_limits.max_unicode_skip),
+                      journal=Journal(args.journal, resume=args.resume) if args.journal else None,
+                      cross_checks=args.cross_checks,
+                      prefetcher=Prefetcher(args.prefetch, args.prefetch_budget * 2 ** 20) if args.prefetch else None,
+                      shard=shard)
+    if args.max_memory is not None:
+        import resource
+        memory = args.max_memory * 2 ** 20
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    sinks = []
+    jsonl_file = None
+    if args.jsonl == '-':
+        sinks.append(JsonlSink(sys.stdout))
+    elif args.jsonl:
+        jsonl_file = open(args.jsonl, 'w', encoding='utf-8')
+        if shard is not None:
+            sinks.append(ShardResultSink(jsonl_file, shard, args.path))
+        else:
+            sinks.append(JsonlSink(jsonl_file))
+    if args.stream:
+        sinks.append(PrintSink())
+    aggregator = Aggregator() if args.summary else None
+    if aggregator is not None:
+        sinks.append(aggregator)
+    # messages are only kept in memory when printed at the end
+    messages = Messages(sinks=sinks, keep=not (args.stream or args.summary or args.jsonl == '-'),
+                        quiet=args.jsonl == '-')
     if args.type is None:
         type = guess_path_type(args.path)
         if type is None:
@@ -610,5 +1912,25 @@ if __name__ == '__main__':
             exit(1)
     else:
         type = args.type
-    process_path(messages, args.path, type)
-    print(messages)
\ No newline at end of file
+    if shard is not None and type != 'sp_list':
+        parser.error('--shard splits the study programs of a 3a_SP_ziadosti directory')
+    process_path(messages, args.path, type, options=options)
+    if options.journal is not None:
+        options.journal.close()
+    if options.prefetcher is not None:
+        options.prefetcher.close()
+    if jsonl_file is not None:
+        if shard is not None:
+            sinks[0].complete()
+        jsonl_file.close()
+    if aggregator is not None:
+        print(aggregator.summary())
+    elif messages.keep:
+        print(messages)
+    if options.timings is not None:
+        for name, seconds in sorted(options.timings.items()):
+            sys.stderr.write('{}: {:.3f} s\n'.format(name, seconds))
+    if args.profile:
+        sys.stderr.write(options.profiler.summary() + '\n')
+        with open(args.profile, 'w') as f:
+            options.profiler.write_trace(f)
\ No newline at end of file
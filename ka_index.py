@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import os.path
+import re
+import sqlite3
+import sys
+import unicodedata
+from array import array
+from contextlib import contextmanager
+from rtf import parse, tokenize, document_content, source_hash, Text, TokenNode, ControlWord, Error, \
+    LAZY_DESTINATIONS
+
+WORD = re.compile(r'\w+')
+
+# control words ending a cell or paragraph, words of a phrase must be in the same one
+UNIT_BREAKS = {b'par', b'line', b'cell', b'row', b'sect', b'page'}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, hash BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS postings (term INTEGER NOT NULL, file INTEGER NOT NULL, positions BLOB NOT NULL,
+                                     PRIMARY KEY (term, file)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_file ON postings (file);
+CREATE TABLE IF NOT EXISTS units (file INTEGER NOT NULL, start INTEGER NOT NULL, text TEXT NOT NULL,
+                                  PRIMARY KEY (file, start)) WITHOUT ROWID;
+'''
+
+
+def fold(text):
+    """Lowercase text without diacritics, so that queries match regardless of them"""
+    return ''.join(c for c in unicodedata.normalize('NFD', text.lower()) if not unicodedata.combining(c))
+
+
+def words(text):
+    return WORD.findall(fold(text))
+
+
+def document_units(document):
+    """Generates decoded text of cells and paragraphs of the document content"""
+    parts = []
+    for node in document_content(document.root):
+        if isinstance(node, Text):
+            parts.append(node.text)
+        elif isinstance(node, TokenNode) and isinstance(node.token, ControlWord) and node.token.word in UNIT_BREAKS:
+            text = ' '.join(''.join(parts).split())
+            if text:
+                yield text
+            parts = []
+    text = ' '.join(''.join(parts).split())
+    if text:
+        yield text
+
+
+class Hit:
+    def __init__(self, path, snippets):
+        self.path = path
+        self.snippets = snippets
+
+    def __repr__(self):
+        return 'Hit({!r}, {!r})'.format(self.path, self.snippets)
+
+
+class Index:
+    """Inverted index of words in cells and paragraphs of RTF forms, stored in an SQLite database.
+
+    For each word and file the positions of the word are stored, so that phrases can be found. Files are
+    identified by path and only reindexed when their content hash changes.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.term_ids = {}
+
+    def close(self):
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """Commits the changes made in the block, or rolls them back together with the cached term ids"""
+        try:
+            with self.connection:
+                yield
+        except BaseException:
+            self.term_ids.clear()
+            raise
+
+    def term_id(self, term, create=False):
+        if term not in self.term_ids:
+            row = self.connection.execute('SELECT id FROM terms WHERE term = ?', (term,)).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                row = (self.connection.execute('INSERT INTO terms (term) VALUES (?)', (term,)).lastrowid,)
+            self.term_ids[term] = row[0]
+        return self.term_ids[term]
+
+    def remove_file(self, file_id):
+        self.connection.execute('DELETE FROM postings WHERE file = ?', (file_id,))
+        self.connection.execute('DELETE FROM units WHERE file = ?', (file_id,))
+        self.connection.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def add_file(self, path):
+        """Indexes the file unless it is indexed with the same content, returns whether it was (re)indexed"""
+        path = os.path.abspath(path)
+        with open(path, 'rb') as f:
+            source = f.read()
+        key = source_hash(source, encoding='cp1250', bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS)
+        row = self.connection.execute('SELECT id, hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[1] == key:
+            return False
+        # forms without \ansicpg are in cp1250, as in ka_autofix.check_rtf
+        document = parse(tokenize(source, bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS), encoding='cp1250')
+        postings = {}
+        units = []
+        position = 0
+        for text in document_units(document):
+            units.append((position, text))
+            for word in words(text):
+                postings.setdefault(word, array('i')).append(position)
+                position += 1
+            position += 1  # phrases do not continue into the next unit
+        with self.transaction():
+            if row is not None:
+                self.remove_file(row[0])
+            file_id = self.connection.execute('INSERT INTO files (path, hash) VALUES (?, ?)', (path, key)).lastrowid
+            self.connection.executemany('INSERT INTO units (file, start, text) VALUES (?, ?, ?)',
+                                        ((file_id, start, text) for start, text in units))
+            self.connection.executemany('INSERT INTO postings (term, file, positions) VALUES (?, ?, ?)',
+                                        ((self.term_id(term, create=True), file_id, positions.tobytes())
+                                         for term, positions in postings.items()))
+        return True
+
+    def update(self, root):
+        """Indexes new and changed .rtf files below root and forgets removed ones, returns counts of
+        (indexed, unchanged, failed, removed) files"""
+        root = os.path.abspath(root)
+        indexed = unchanged = failed = 0
+        seen = set()
+        if os.path.isfile(root):
+            paths = [root]
+        else:
+            paths = (os.path.join(directory, name) for directory, dirnames, names in os.walk(root)
+                     for name in sorted(names) if name.lower().endswith('.rtf'))
+        for path in paths:
+            seen.add(path)
+            try:
+                if self.add_file(path):
+                    indexed += 1
+                else:
+                    unchanged += 1
+            except (Error, OSError) as e:
+                print('{}: {}'.format(path, e), file=sys.stderr)
+                failed += 1
+        removed = 0
+        prefix = root if os.path.isfile(root) else os.path.join(root, '')
+        for file_id, path in self.connection.execute('SELECT id, path FROM files').fetchall():
+            if (path == root or path.startswith(prefix)) and path not in seen:
+                with self.transaction():
+                    self.remove_file(file_id)
+                removed += 1
+        return indexed, unchanged, failed, removed
+
+    def positions(self, term):
+        """Returns {file id: positions} of a folded word"""
+        term_id = self.term_id(term)
+        if term_id is None:
+            return {}
+        ret = {}
+        for file_id, blob in self.connection.execute('SELECT file, positions FROM postings WHERE term = ?',
+                                                     (term_id,)):
+            positions = array('i')
+            positions.frombytes(blob)
+            ret[file_id] = positions
+        return ret
+
+    def phrase_positions(self, phrase):
+        """Returns {file id: start positions} of a word or phrase"""
+        terms = words(phrase)
+        if not terms:
+            return {}
+        # start with the rarest word to keep the candidate files few
+        postings = [self.positions(term) for term in terms]
+        files = set(min(postings, key=len))
+        for term_postings in postings:
+            files &= set(term_postings)
+        ret = {}
+        for file_id in files:
+            starts = set(postings[0][file_id])
+            for offset, term_postings in enumerate(postings[1:], 1):
+                starts &= {position - offset for position in term_postings[file_id]}
+            if starts:
+                ret[file_id] = sorted(starts)
+        return ret
+
+    def search(self, queries, snippets=3):
+        """Returns Hits of files containing all queries (words or phrases), with texts of the first matching
+        cells or paragraphs"""
+        matches = None
+        for query in queries:
+            found = self.phrase_positions(query)
+            if matches is None:
+                matches = {file_id: list(starts) for file_id, starts in found.items()}
+            else:
+                matches = {file_id: matches[file_id] + starts for file_id, starts in found.items()
+                           if file_id in matches}
+        hits = []
+        for file_id, starts in (matches or {}).items():
+            path = self.connection.execute('SELECT path FROM files WHERE id = ?', (file_id,)).fetchone()[0]
+            texts = []
+            for start in sorted(starts):
+                text = self.connection.execute('SELECT text FROM units WHERE file = ? AND start <= ? '
+                                               'ORDER BY start DESC LIMIT 1', (file_id, start)).fetchone()[0]
+                if text not in texts:
+                    texts.append(text)
+                if len(texts) >= snippets:
+                    break
+            hits.append(Hit(path, texts))
+        hits.sort(key=lambda hit: hit.path)
+        return hits
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='full-text index of RTF forms')
+    parser.add_argument('database')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    update_parser = subparsers.add_parser('update', help='index new and changed forms below the paths')
+    update_parser.add_argument('paths', nargs='+')
+    query_parser = subparsers.add_parser('query', help='list forms containing all words or "phrases"')
+    query_parser.add_argument('queries', nargs='+')
+    args = parser.parse_args()
+
+    index = Index(args.database)
+    start = time.perf_counter()
+    if args.command == 'update':
+        for path in args.paths:
+            counts = index.update(path)
+            sys.stderr.write('{}: indexovanych {}, nezmenenych {}, chybnych {}, odstranenych {}\n'.format(
+                path, *counts))
+    else:
+        for hit in index.search(args.queries):
+            print(hit.path)
+            for text in hit.snippets:
+                print('    ' + text)
+    sys.stderr.write('{:.3f} s\n'.format(time.perf_counter() - start))
+    index.close()
@@ -3,11 +3,23 @@
 from __future__ import print_function
 from itertools import takewhile
 from io import BytesIO
+import binascii
+import codecs
+import csv
+from abc import ABCMeta, abstractmethod
 import re
 from copy import copy
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import deque
+from difflib import SequenceMatcher
+from hashlib import sha1
+import os
+import pickle
+import struct
 import sys
-from six import u, Iterator, PY2, byte2int, unichr, int2byte
+import time
+from six import u, Iterator, PY2, byte2int, unichr, int2byte, string_types, add_metaclass
 
 
 # https://docs.python.org/3/howto/pyporting.html#str-unicode
@@ -27,7 +39,7 @@ class Error(Exception):
     pass
 
 
-class ParseError(Error, UnicodeMixin):
+class ParseError(UnicodeMixin, Error):
     def __init__(self, position, description):
         self.position = position
         self.description = description
@@ -36,6 +48,47 @@ class ParseError(Error, UnicodeMixin):
         return u('Parse error at position {}: {}').format(self.position, self.description)
 
 
+def report_error(errors, error):
+    """Raises error, or appends it to errors if they are being collected (errors is a list)"""
+    if errors is None:
+        raise error
+    errors.append(error)
+
+
+class LimitExceeded(UnicodeMixin, Error):
+    def __init__(self, position, limit, value):
+        self.position = position
+        self.limit = limit
+        self.value = value
+
+    def __unicode__(self):
+        return u('Limit {} exceeded at position {}: {}').format(self.limit, self.position, self.value)
+
+
+class Limits(object):
+    """Budgets for one document enforced by tokenize and parse, None means unlimited.
+
+    Sizes are in bytes, max_seconds is wall time since tokenize started; token count, size and time are
+    checked every CHECK_INTERVAL tokens.
+    """
+    CHECK_INTERVAL = 1024
+
+    def __init__(self, max_size=None, max_depth=None, max_tokens=None, max_seconds=None, max_unicode_skip=None):
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.max_unicode_skip = max_unicode_skip
+
+    def check(self, tokens, pos, start):
+        if self.max_tokens is not None and tokens > self.max_tokens:
+            raise LimitExceeded(pos, 'max_tokens', tokens)
+        if self.max_size is not None and pos > self.max_size:
+            raise LimitExceeded(pos, 'max_size', pos)
+        if self.max_seconds is not None and time.time() - start > self.max_seconds:
+            raise LimitExceeded(pos, 'max_seconds', round(time.time() - start, 3))
+
+
 class PeekIter(Iterator):
     def __init__(self, iterable):
         self._iterator = iter(iterable)
@@ -69,7 +122,7 @@ class PeekIter(Iterator):
 def ascii_as_bytes(s):
     if PY2:
         return s
-    return s.decode('ascii')
+    return s.encode('ascii')
 
 
 def ascii_as_str(s):
@@ -82,32 +135,106 @@ def number_as_bytes(num):
     return ascii_as_bytes(str(num))
 
 
+GROUP_SCAN = re.compile(b'[{}\\\\]')
+BIN_WORD = re.compile(b'bin([0-9]+) ?')
+
+
 class ByteStream(object):
-    def __init__(self, file):
+    def __init__(self, file, buffer_size=65536, offset=0):
         if isinstance(file, bytes):
             file = BytesIO(file)
         self._file = file
+        self._buffer_size = buffer_size
         self._buf = b''
-        self.pos = 0
+        self._index = 0
+        self._offset = offset  # position of the start of the buffer within the stream
+
+    @property
+    def pos(self):
+        return self._offset + self._index
 
     def _readbuf(self):
-        if self.pos == len(self._buf):
-            self._buf = self._file.read(1024)
-            self.pos = 0
+        if self._index == len(self._buf):
+            self._offset += len(self._buf)
+            self._buf = self._file.read(self._buffer_size)
+            self._index = 0
 
     def get(self):
         self._readbuf()
-        if self.pos == len(self._buf):
+        if self._index == len(self._buf):
             return b''
-        ret = self._buf[self.pos:self.pos+1]
-        self.pos += 1
+        ret = self._buf[self._index:self._index+1]
+        self._index += 1
         return ret
 
     def peek(self):
         self._readbuf()
-        if self.pos == len(self._buf):
+        if self._index == len(self._buf):
             return b''
-        return self._buf[self.pos:self.pos+1]
+        return self._buf[self._index:self._index+1]
+
+    def read(self, size):
+        """Reads up to size bytes"""
+        parts = []
+        while size > 0:
+            self._readbuf()
+            if self._index == len(self._buf):
+                break
+            chunk = self._buf[self._index:self._index+size]
+            self._index += len(chunk)
+            size -= len(chunk)
+            parts.append(chunk)
+        return b''.join(parts)
+
+    def lookahead(self, size):
+        """Returns up to size next bytes without consuming them"""
+        if len(self._buf) - self._index < size:
+            self._buf = self._buf[self._index:] + self._file.read(max(size, self._buffer_size))
+            self._offset += self._index
+            self._index = 0
+        return self._buf[self._index:self._index+size]
+
+    def read_group(self):
+        """Reads the rest of a group whose opening brace was already read, returns raw bytes including braces"""
+        parts = [b'{']
+        depth = 1
+        while True:
+            self._readbuf()
+            if self._index == len(self._buf):
+                raise ParseError(self.pos, 'Unterminated group')
+            m = GROUP_SCAN.search(self._buf, self._index)
+            if m is None:
+                parts.append(self._buf[self._index:])
+                self._index = len(self._buf)
+                continue
+            parts.append(self._buf[self._index:m.end()])
+            self._index = m.end()
+            if m.group() == b'{':
+                depth += 1
+            elif m.group() == b'}':
+                depth -= 1
+                if depth == 0:
+                    return b''.join(parts)
+            else:
+                bin_word = BIN_WORD.match(self.lookahead(40))
+                if bin_word:
+                    parts.append(self.read(bin_word.end()))
+                    parts.append(self.read(int(bin_word.group(1))))
+                else:
+                    # escaped character or the first letter of a control word, \{ and \} must not count
+                    parts.append(self.read(1))
+
+    def read_run(self, pattern):
+        """Reads the longest run of bytes matched by pattern, a compiled regex like b'[abc]*'"""
+        parts = []
+        while True:
+            self._readbuf()
+            end = pattern.match(self._buf, self._index).end()
+            parts.append(self._buf[self._index:end])
+            self._index = end
+            if end < len(self._buf) or not self._buf:
+                break
+        return b''.join(parts)
 
 
 class Token(object):
@@ -116,6 +243,8 @@ class Token(object):
 
 
 class ControlWord(Token):
+    number_text = None  # digits as written in the source if they differ from number_as_bytes(number)
+
     def __init__(self, word, number=None, pos=None, trailing=None):
         super(ControlWord, self).__init__(pos=pos)
         self.word = word
@@ -127,7 +256,9 @@ class ControlWord(Token):
 
     def __bytes__(self):
         ret = b'\\' + self.word
-        if self.number is not None:
+        if self.number_text is not None and int(self.number_text) == self.number:
+            ret += self.number_text
+        elif self.number is not None:
             ret += number_as_bytes(self.number)
         ret += self.trailing
         return ret
@@ -146,7 +277,10 @@ class ControlWord(Token):
 
 
 class BinaryData(Token):
+    number_text = None  # length as written in the source if it differs from number_as_bytes(len(data))
+
     def __init__(self, data, pos=None, trailing=None):
+        super(BinaryData, self).__init__(pos=pos)
         self.data = data
         if trailing is None:
             self.trailing = b''
@@ -155,7 +289,10 @@ class BinaryData(Token):
 
     def __bytes__(self):
         ret = b'\\bin'
-        ret += number_as_bytes(len(self.data))
+        if self.number_text is not None and int(self.number_text) == len(self.data):
+            ret += self.number_text
+        else:
+            ret += number_as_bytes(len(self.data))
         ret += self.trailing
         ret += self.data
         return ret
@@ -169,6 +306,64 @@ class BinaryData(Token):
         return not self == other
 
 
+class SkippedGroup(Token):
+    """Group of a destination read as raw bytes without tokenizing it, see tokenize(lazy_destinations=...)"""
+    def __init__(self, raw, destination, invisible=False, pos=None, bulk_hex=False):
+        super(SkippedGroup, self).__init__(pos=pos)
+        self.raw = raw
+        self.destination = destination
+        self.invisible = invisible
+        self.bulk_hex = bulk_hex  # how to tokenize raw later
+
+    def __bytes__(self):
+        return self.raw
+
+    def __repr__(self):
+        return 'SkippedGroup({!r}, <{} bytes>, pos={!r})'.format(self.destination, len(self.raw), self.pos)
+
+    def __eq__(self, other):
+        return isinstance(other, SkippedGroup) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+
+HEX_RUN = re.compile(b'[0-9a-fA-F\r\n\t ]*')
+HEX_WHITESPACE = re.compile(b'[\r\n\t ]+')
+
+
+class HexData(Token):
+    """Run of hexadecimal digits (and line breaks) forming the payload of \\pict or \\objdata"""
+    def __init__(self, raw, pos=None):
+        super(HexData, self).__init__(pos=pos)
+        self.raw = raw
+
+    def __bytes__(self):
+        return self.raw
+
+    @property
+    def digits(self):
+        return HEX_WHITESPACE.sub(b'', self.raw)
+
+    @property
+    def size(self):
+        return len(self.digits) // 2
+
+    @property
+    def data(self):
+        digits = self.digits
+        return binascii.unhexlify(digits[:len(digits) // 2 * 2])
+
+    def __repr__(self):
+        return 'HexData(<{} bytes>, pos={!r})'.format(self.size, self.pos)
+
+    def __eq__(self, other):
+        return isinstance(other, HexData) and self.raw == other.raw
+
+    def __ne__(self, other):
+        return not self == other
+
+
 class ControlSymbol(Token):
     def __init__(self, symbol, pos=None):
         super(ControlSymbol, self).__init__(pos=pos)
@@ -215,6 +410,12 @@ class Char(Token):
     def __repr__(self):
         return '{}({!r}, pos={!r})'.format(self.__class__.__name__, self.ordinal, self.pos)
 
+    def __eq__(self, other):
+        return type(self) is type(other) and self.ordinal == other.ordinal
+
+    def __ne__(self, other):
+        return not self == other
+
 
 class RawChar(Char):
     def __bytes__(self):
@@ -222,7 +423,11 @@ class RawChar(Char):
 
 
 class ANSIEscapedChar(Char):
+    hex_text = None  # hex digits as written in the source if they are not lowercase
+
     def __bytes__(self):
+        if self.hex_text is not None and int(self.hex_text, 16) == self.ordinal:
+            return b'\\\'' + self.hex_text
         return b'\\\'' + ascii_as_bytes(hex(self.ordinal)[2:].zfill(2))
 
 
@@ -244,56 +449,151 @@ class GroupBoundary(Token):
         return not (self == other)
 
 
-def tokenize(bs):
+HEX_DESTINATIONS = {b'pict', b'objdata'}
+
+# Destinations which are not part of the document content (see document_content)
+NON_CONTENT_DESTINATIONS = {b'colortbl', b'fonttbl', b'stylesheet', b'themedata', b'header', b'headerl', b'headerr',
+                            b'headerf', b'footer', b'footerl', b'footerr', b'footerf', b'footnote', b'info',
+                            b'mmathPr', b'listtable', b'listoverridetable'}
+
+LAZY_DESTINATIONS = NON_CONTENT_DESTINATIONS | {b'latentstyles', b'datastore', b'colorschememapping', b'rsidtbl',
+                                                b'xmlnstbl', b'generator'}
+
+HEX_ESCAPE = re.compile(b'[0-9a-fA-F]{2}')
+
+# longest control word name and number; longer runs of letters or digits are an error, in recovery mode
+# the rest of them is read as text
+MAX_WORD_LENGTH = 32
+
+LAZY_GROUP_START = re.compile(b'(\\\\\\*)?[\r\n]*\\\\([a-zA-Z]{1,32})')
+
+
+def tokenize(bs, bulk_hex=False, lazy_destinations=None, limits=None, errors=None):
+    """Generates tokens from a byte string, file or ByteStream.
+
+    With bulk_hex, hexadecimal payload of \\pict and \\objdata groups is read as HexData tokens
+    instead of a RawChar per digit.
+
+    Groups of destinations in lazy_destinations (e.g. LAZY_DESTINATIONS) are only brace-matched and
+    returned as SkippedGroup tokens, parse turns them into LazyGroup nodes.
+
+    Limits (size, nesting depth, token count, time) raise LimitExceeded when exceeded.
+
+    If errors is a list, ParseErrors are appended to it instead of raised and tokenizing goes on after the
+    offending bytes.
+    """
     if not isinstance(bs, ByteStream):
         bs = ByteStream(bs)
+    depth = 0
+    hex_depth = None
+    if limits is not None:
+        start = time.time()
+        count = 0
+        max_depth = limits.max_depth
+        max_size = limits.max_size
     while True:
         b = bs.peek()
         loop_pos = bs.pos
+        if limits is not None:
+            count += 1
+            if count % Limits.CHECK_INTERVAL == 0:
+                limits.check(count, loop_pos, start)
         if b == b'':
             return
         elif b == b'{':
             bs.get()
+            if lazy_destinations:
+                m = LAZY_GROUP_START.match(bs.lookahead(40))
+                if m and m.group(2) in lazy_destinations:
+                    try:
+                        raw = bs.read_group()
+                    except ParseError as e:
+                        report_error(errors, e)
+                        return
+                    token = SkippedGroup(raw, m.group(2), invisible=m.group(1) is not None, pos=loop_pos,
+                                         bulk_hex=bulk_hex)
+                    if limits is not None and max_size is not None and bs.pos > max_size:
+                        raise LimitExceeded(bs.pos, 'max_size', bs.pos)
+                    yield token
+                    continue
+            depth += 1
+            if limits is not None and max_depth is not None and depth > max_depth:
+                raise LimitExceeded(loop_pos, 'max_depth', depth)
             yield GroupBoundary(opening=True, pos=loop_pos)
         elif b == b'}':
             bs.get()
+            if depth == hex_depth:
+                hex_depth = None
+            depth -= 1
             yield GroupBoundary(opening=False, pos=loop_pos)
+        elif hex_depth == depth and b in b'0123456789abcdefABCDEF\r\n\t ':
+            yield HexData(bs.read_run(HEX_RUN), pos=loop_pos)
         elif b == b'\\':
             bs.get()
             if b'a' <= bs.peek() <= b'z' or b'A' <= bs.peek() <= b'Z':
                 # control word
-                num = 0
                 word = b''
                 trailing = b''
                 while b'a' <= bs.peek() <= b'z' or b'A' <= bs.peek() <= b'Z':
+                    if len(word) == MAX_WORD_LENGTH:
+                        report_error(errors, ParseError(bs.pos, 'Too long control word'))
+                        break
                     word += bs.get()
-                    num += 1
-                    if num > 32:
-                        raise ParseError(bs.pos, 'Too long control word')
                 number = None
+                number_text = None
                 if bs.peek() == b' ':
                     trailing = bs.get()
                 elif b'0' <= bs.peek() <= b'9' or bs.peek() == b'-':
                     number = bs.get()
                     while b'0' <= bs.peek() <= b'9':
+                        if len(number) == MAX_WORD_LENGTH:
+                            report_error(errors, ParseError(bs.pos, 'Too long number'))
+                            break
                         number += bs.get()
+                    if number == b'-':
+                        report_error(errors, ParseError(loop_pos, 'Missing number after -'))
+                        number = None
                     if bs.peek() == b' ':
                         trailing = bs.get()
-                    number = int(ascii_as_str(number))
-                if word == b'bin':
-                    if number < 0:
-                        raise ParseError(loop_pos, 'Negative \\bin')
-                    skip = number
-                    data = b''
-                    while skip > 0:
-                        data += bs.get()
-                    yield BinaryData(data, pos=loop_pos, trailing=trailing)
-                else:
+                    if number is not None:
+                        number_text = number
+                        number = int(ascii_as_str(number))
+                        if number_as_bytes(number) == number_text:
+                            number_text = None
+                if word == b'bin' and number is not None and number < 0:
+                    report_error(errors, ParseError(loop_pos, 'Negative \\bin'))
                     yield ControlWord(word, number=number, pos=loop_pos, trailing=trailing)
+                elif word == b'bin':
+                    if number is None:
+                        number = 0
+                    if limits is not None and max_size is not None and number > max_size:
+                        raise LimitExceeded(loop_pos, 'max_size', number)
+                    data = bs.read(number)
+                    if len(data) < number:
+                        report_error(errors, ParseError(bs.pos, 'Unexpected end of \\bin data'))
+                    token = BinaryData(data, pos=loop_pos, trailing=trailing)
+                    if number_text is not None:
+                        token.number_text = number_text
+                    yield token
+                else:
+                    if bulk_hex and word in HEX_DESTINATIONS:
+                        hex_depth = depth
+                    token = ControlWord(word, number=number, pos=loop_pos, trailing=trailing)
+                    if number_text is not None:
+                        token.number_text = number_text
+                    yield token
             elif bs.peek() == b'\'':
                 bs.get()
-                ordval = int(bs.get() + bs.get(), 16)
-                yield ANSIEscapedChar(ordval)
+                hex_text = bs.lookahead(2)
+                if len(hex_text) < 2 or not HEX_ESCAPE.match(hex_text):
+                    report_error(errors, ParseError(loop_pos, 'Malformed \\\' escape'))
+                    yield ControlSymbol(b'\'', pos=loop_pos)
+                    continue
+                bs.read(2)
+                token = ANSIEscapedChar(int(hex_text, 16), pos=loop_pos)
+                if hex_text != hex_text.lower():
+                    token.hex_text = hex_text
+                yield token
             else:
                 yield ControlSymbol(bs.get(), pos=loop_pos)
         elif b == b'\r' or b == b'\n':
@@ -305,19 +605,60 @@ def tokenize(bs):
             yield RawChar(byte2int(bs.get()), pos=loop_pos)
 
 
+def token_digest(token):
+    """Returns bytes identifying the token in structural hashes, consistent with token equality"""
+    if isinstance(token, ControlWord):
+        ret = b'\\' + token.word
+        if token.number is not None:
+            ret += number_as_bytes(token.number)
+        return ret
+    elif isinstance(token, Separator):
+        return b'\n'
+    return bytes(token)
+
+
+@add_metaclass(ABCMeta)
 class Node(object):
     def __init__(self, parent=None):
         self.parent = parent
+        self._digest = None
 
     def walk(self):
         yield self
 
+    @property
+    def digest(self):
+        """Structural (Merkle) hash of the subtree, computed lazily and cached until the subtree changes"""
+        if self._digest is None:
+            self._digest = self.compute_digest()
+        return self._digest
+
+    @abstractmethod
+    def compute_digest(self):
+        """Returns the digest of the subtree, see digest"""
+
+    def invalidate(self):
+        """Drops cached values of the node and its ancestors, must be called after changing the tree in place"""
+        self._digest = None
+        node = self.parent
+        while node is not None and (node._digest is not None or node._text is not None):
+            node._digest = None
+            node._text = None
+            node = node.parent
+
 
 class Text(Node):
     def __init__(self, text, tokens=None, parent=None):
         super(Text, self).__init__(parent=parent)
         self.tokens = tokens
         self._text = text
+        self.formatting = None
+        # Text appended in one append() call starts at char_starts[i] and comes from tokens[token_starts[i]:]
+        self.char_starts = array('l')
+        self.token_starts = array('l')
+        if text and tokens:
+            self.char_starts.append(0)
+            self.token_starts.append(0)
 
     @property
     def text(self):
@@ -328,19 +669,73 @@ class Text(Node):
         if text != self._text:
             self._text = text
             self.tokens = None
+            self.char_starts = array('l')
+            self.token_starts = array('l')
+            self.invalidate()
 
     def append(self, text, tokens):
+        self.char_starts.append(len(self._text))
+        self.token_starts.append(len(self.tokens))
         self._text += text
         self.tokens.extend(tokens)
+        self.invalidate()
+
+    def splice(self, start, end, text, encoding=None, unicode_skip=1):
+        """Replaces text[start:end] by text, re-encoding only the tokens of the characters that changed"""
+        if self.tokens is None:
+            self.text = self._text[:start] + text + self._text[end:]
+            return
+        # extend the range to whole append() chunks, tokens of the rest are kept as they are
+        first = max(bisect_right(self.char_starts, start) - 1, 0)
+        last = bisect_left(self.char_starts, end)
+        chunks = len(self.char_starts)
+        char_start = self.char_starts[first] if first < chunks else 0
+        char_end = self.char_starts[last] if last < chunks else len(self._text)
+        token_start = self.token_starts[first] if first < chunks else 0
+        token_end = self.token_starts[last] if last < chunks else len(self.tokens)
+        new_text = self._text[char_start:start] + text + self._text[end:char_end]
+        new_tokens = list(escape_text_tokens(new_text, encoding=encoding, unicode_skip=unicode_skip))
+        char_delta = len(new_text) - (char_end - char_start)
+        token_delta = len(new_tokens) - (token_end - token_start)
+        char_starts = self.char_starts[:first]
+        token_starts = self.token_starts[:first]
+        if new_tokens:
+            char_starts.append(char_start)
+            token_starts.append(token_start)
+        for index in range(last, chunks):
+            char_starts.append(self.char_starts[index] + char_delta)
+            token_starts.append(self.token_starts[index] + token_delta)
+        self.char_starts = char_starts
+        self.token_starts = token_starts
+        self.tokens[token_start:token_end] = new_tokens
+        self._text = self._text[:char_start] + new_text + self._text[char_end:]
+        self.invalidate()
+
+    def source_pos(self, index):
+        """Returns position in the source of the character at index (or the end of text), None if unknown"""
+        if not self.tokens:
+            return None
+        if index >= len(self._text):
+            last = self.tokens[-1]
+            if last.pos is None:
+                return None
+            return last.pos + len(bytes(last))
+        chunk = bisect_right(self.char_starts, index) - 1
+        if chunk < 0 or self.token_starts[chunk] >= len(self.tokens):
+            return None
+        return self.tokens[self.token_starts[chunk]].pos
+
+    def compute_digest(self):
+        return sha1(b'T' + self._text.encode('utf-8')).digest()
 
     def __repr__(self):
         return 'Text({!r}, tokens={!r})'.format(self._text, self.tokens)
 
     def __eq__(self, other):
-        return self.text == other.text
+        return isinstance(other, Text) and self.text == other.text
 
     def __ne__(self, other):
-        return self.text != other.text
+        return not self == other
 
 
 RTF_DESTINATIONS = {
@@ -397,13 +792,24 @@ RTF_DESTINATIONS = {
 
 
 class Group(Node):
+    """Group of child nodes.
+
+    Children are added with append, which sets their parent. Whoever changes content directly must set the
+    parent of new children and call invalidate() afterwards, otherwise cached values such as digests (and thus
+    equality) are stale.
+    """
     def __init__(self, content=None, pos=None, parent=None):
         super(Group, self).__init__(parent=parent)
+        self._text = None
         if content is None:
             self.content = []
         else:
             self.content = content
+            for child in content:
+                child.parent = self
         self.pos = pos
+        self.end = None  # position of the closing brace
+        self.formatting = None
 
     def __bytes__(self):
         return b'{' + b''.join(bytes(x) for x in self.content) + b'}'
@@ -419,6 +825,21 @@ class Group(Node):
             raise ValueError('A node can only be inserted once')
         node.parent = self
         self.content.append(node)
+        self.invalidate()
+
+    def invalidate(self):
+        self._text = None
+        super(Group, self).invalidate()
+
+    @property
+    def text(self):
+        """Text of the whole subtree, cached until the subtree changes"""
+        if self._text is None:
+            self._text = as_text(self.content)
+        return self._text
+
+    def compute_digest(self):
+        return sha1(b'G' + b''.join(child.digest for child in self.content)).digest()
 
     @property
     def destination(self):
@@ -439,15 +860,68 @@ class Group(Node):
         return destination, invisible
 
     def __eq__(self, other):
-        return self.content == other.content
+        return isinstance(other, Group) and self.digest == other.digest
 
     def __ne__(self, other):
-        return self.content != other.content
+        return not self == other
 
     def __repr__(self):
         return '<Group {!r}>'.format(self.content)
 
 
+class LazyGroup(Group):
+    """Group kept as raw bytes and parsed when its content is first accessed.
+
+    If errors is a list, parse errors of the content are appended to it instead of raised.
+    """
+    bulk_hex = False  # default for snapshots pickled before the attribute existed
+
+    def __init__(self, raw, destination, invisible=False, pos=None, encoding=None, unicode_skip=1, parent=None,
+                 errors=None, bulk_hex=False):
+        super(LazyGroup, self).__init__(pos=pos, parent=parent)
+        self.raw = raw
+        self.bulk_hex = bulk_hex
+        self.encoding = encoding
+        self.unicode_skip = unicode_skip
+        self.errors = errors
+        self._content = None
+        self._destination = TokenNode(ControlWord(destination)), invisible
+
+    @property
+    def materialized(self):
+        return self._content is not None
+
+    @property
+    def content(self):
+        if self._content is None:
+            root = parse(tokenize(ByteStream(self.raw, offset=self.pos), bulk_hex=self.bulk_hex, errors=self.errors),
+                         encoding=self.encoding, unicode_skip=self.unicode_skip, errors=self.errors).root
+            for child in root.content:
+                child.parent = self
+            self._content = root.content
+            self.raw = None
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+    @property
+    def destination(self):
+        if self._content is None:
+            return self._destination
+        return super(LazyGroup, self).destination
+
+
+def lazy_group(token, encoding, unicode_skip, errors=None):
+    """Creates a LazyGroup from a SkippedGroup token"""
+    group = LazyGroup(token.raw, token.destination, invisible=token.invisible, pos=token.pos, encoding=encoding,
+                      unicode_skip=unicode_skip, errors=errors, bulk_hex=token.bulk_hex)
+    if token.pos is not None:
+        group.end = token.pos + len(token.raw) - 1
+    return group
+
+
 class TokenNode(Node):
     def __init__(self, token, parent=None):
         super(TokenNode, self).__init__(parent=parent)
@@ -456,6 +930,9 @@ class TokenNode(Node):
     def __repr__(self):
         return 'TokenNode({!r})'.format(self.token)
 
+    def compute_digest(self):
+        return sha1(b'N' + token_digest(self.token)).digest()
+
     def __eq__(self, other):
         return isinstance(other, TokenNode) and self.token == other.token
 
@@ -467,27 +944,103 @@ class Scope(object):
     def __init__(self, group):
         self.group = group
         self.unicode_skip = 1
+        self.formatting = None
+
+
+class Formatting(object):
+    """Character and paragraph formatting of a run of text.
+
+    Instances are immutable and interned, so that all Text nodes with the same formatting share one object.
+    Size is in half-points, style is the paragraph style number (\\s).
+    """
+    __slots__ = ('bold', 'italic', 'font', 'size', 'style')
+    _instances = {}
+
+    def __new__(cls, bold=False, italic=False, font=None, size=24, style=0):
+        key = (bold, italic, font, size, style)
+        instance = cls._instances.get(key)
+        if instance is None:
+            instance = object.__new__(cls)
+            for name, value in zip(cls.__slots__, key):
+                object.__setattr__(instance, name, value)
+            cls._instances[key] = instance
+        return instance
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Formatting is immutable')
+
+    def __reduce__(self):
+        return Formatting, tuple(getattr(self, name) for name in self.__slots__)
+
+    def replace(self, **changes):
+        values = dict((name, getattr(self, name)) for name in self.__slots__)
+        values.update(changes)
+        return Formatting(**values)
+
+    def __repr__(self):
+        return 'Formatting({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                                 for name in self.__slots__))
+
+
+FORMATTING_WORDS = {b'b', b'i', b'f', b'fs', b's', b'pard', b'plain', b'deff'}
+
+
+def update_formatting(formatting, token, default_font):
+    """Returns formatting after the control word token"""
+    word = token.word
+    if word == b'b':
+        return formatting.replace(bold=token.number != 0)
+    elif word == b'i':
+        return formatting.replace(italic=token.number != 0)
+    elif word == b'f':
+        return formatting.replace(font=token.number)
+    elif word == b'fs':
+        return formatting.replace(size=24 if token.number is None else token.number)
+    elif word == b's':
+        return formatting.replace(style=token.number or 0)
+    elif word == b'pard':
+        return formatting.replace(style=0)
+    elif word == b'plain':
+        return formatting.replace(bold=False, italic=False, font=default_font, size=24)
+    elif word == b'deff' and formatting.font is None:
+        return formatting.replace(font=token.number)
+    return formatting
 
 
 RTF_ENCODINGS = {
     10000: 'mac_roman',
-    10001: 'mac_japan',
+    10001: 'shift_jis',  # Python has no mac_japan codec, Shift JIS is its base
+    10002: 'big5',
+    10003: 'euc_kr',
+    10008: 'gb2312',
     10005: 'mac_greek',
     10007: 'mac_cyrillic',
     10029: 'mac_latin2',
     10081: 'mac_turkish'
 }
 
+CHARSET_ENCODINGS = {b'ansi': 'ascii', b'pc': 'cp437', b'pca': 'cp850'}
+
 
 class Document(Node):
-    def __init__(self, root, trailing=None):
+    def __init__(self, root, trailing=None, encoding=None, errors=None, default_font=None):
         super(Document, self).__init__(parent=None)
         self.root = root
         self.trailing = trailing
+        self.encoding = encoding
+        self.errors = errors if errors is not None else []
+        self.default_font = default_font  # \deff, set when formatting is tracked
 
     def walk(self):
         return self.root.walk()
 
+    @property
+    def digest(self):
+        return self.root.digest
+
+    def compute_digest(self):
+        return self.root.digest
+
     def __eq__(self, other):
         return self.root == other.root
 
@@ -498,105 +1051,443 @@ class Document(Node):
         return 'Document({!r}, trailing={!r})'.format(self.root, self.trailing)
 
 
-def parse(tokens, encoding=None):
+def parse(tokens, encoding=None, unicode_skip=1, track_formatting=False, formatting=None, limits=None,
+          errors=None, default_font=None):
+    """Parses tokens into a Document.
+
+    With track_formatting, bold, italic, font, size and paragraph style are tracked with proper group
+    scoping (starting from formatting) and every Text node and Group gets the Formatting in effect at
+    its start as its formatting attribute. default_font is the font of \\plain until a \\deff is found.
+
+    Of limits, nesting depth and \\uc are checked here, the rest by tokenize.
+
+    If errors is a list (usually the one passed to tokenize), ParseErrors are appended to it instead of
+    raised and a best-effort Document is returned with them in its errors attribute: a token after an
+    unbalanced } continues the root group and groups left open at the end are reported.
+    """
+    max_depth = limits.max_depth if limits is not None else None
+    max_unicode_skip = limits.max_unicode_skip if limits is not None else None
     tokens = PeekIter(tokens)
     effective = type("", (), {})()  # http://stackoverflow.com/a/7935984
     effective.encoding = 'ascii' if encoding is None else encoding
-
-    def set_encoding(name):
-        if encoding is None:
-            effective.encoding = name
-
-    open_brace = next(tokens)
-    if open_brace != GroupBoundary(opening=True):
-        raise ParseError(open_brace.pos, 'Expecting {')
-    root = Group(pos=open_brace.pos)
+    effective.default_font = default_font
+    decoder = CharDecoder(effective.encoding)
+
+    open_brace = tokens.peek()
+    # whether the root group is not expected to be closed at the end, an error was reported already
+    root_closed = open_brace != GroupBoundary(opening=True)
+    if root_closed:
+        report_error(errors, ParseError(getattr(open_brace, 'pos', 0), 'Expecting {'))
+        root = Group(pos=0)
+    else:
+        root = Group(pos=next(tokens).pos)
 
     stack = [Scope(root)]
+    stack[0].unicode_skip = unicode_skip
+    if track_formatting:
+        stack[0].formatting = root.formatting = formatting or Formatting()
 
     def combine_text(text, tokens):
-        if stack[-1].group.content and isinstance(stack[-1].group.content[-1], Text):
-            text_node = stack[-1].group.content[-1]
+        content = stack[-1].group.content
+        if content and isinstance(content[-1], Text) and content[-1].formatting is stack[-1].formatting:
+            text_node = content[-1]
         else:
             text_node = Text('', [])
+            text_node.formatting = stack[-1].formatting
             stack[-1].group.append(text_node)
         text_node.append(text, tokens)
 
-    for token in tokens:
-        if token == GroupBoundary(opening=True):
-            new_scope = copy(stack[-1])
-            new_scope.group = Group(pos=token.pos)
-            stack[-1].group.append(new_scope.group)
-            stack.append(new_scope)
-        elif token == GroupBoundary(opening=False):
-            stack.pop()
-            if len(stack) == 0:
-                break
-        elif isinstance(token, Char):
-            try:
-                ba = bytearray()
-                ba.append(token.ordinal)
-                decoded_text = ba.decode(effective.encoding)
-            except UnicodeDecodeError:
+    root_scope = stack[0]
+    while True:
+        for token in tokens:
+            if decoder.pending and not isinstance(token, Char):
+                # a multi-byte character cut short, its bytes are kept as they are
+                for undecoded in decoder.flush():
+                    stack[-1].group.append(TokenNode(undecoded))
+            if token == GroupBoundary(opening=True):
+                new_scope = copy(stack[-1])
+                new_scope.group = Group(pos=token.pos)
+                new_scope.group.formatting = new_scope.formatting
+                stack[-1].group.append(new_scope.group)
+                stack.append(new_scope)
+                if max_depth is not None and len(stack) > max_depth:
+                    raise LimitExceeded(token.pos, 'max_depth', len(stack))
+            elif token == GroupBoundary(opening=False):
+                stack.pop().group.end = token.pos
+                if len(stack) == 0:
+                    break
+            elif isinstance(token, Char):
+                while token is not None:
+                    decoded_text = decoder.decode(token)
+                    if decoded_text:
+                        combine_text(decoded_text, decoder.take())
+                    elif decoded_text is None:
+                        for undecoded in decoder.take():
+                            stack[-1].group.append(TokenNode(undecoded))
+                    token = decoder.take_retry()
+            elif isinstance(token, ControlWord):
+                if token.word == b'u' and token.number is None:
+                    report_error(errors, ParseError(token.pos, '\\u requires argument'))
+                elif token.word == b'u' and not -32768 <= token.number <= 65535:
+                    report_error(errors, ParseError(token.pos, '\\u out of range'))
+                elif token.word == b'u':  # unicode text
+                    ordinal = token.number
+                    if ordinal < 0:
+                        ordinal += 65536
+                    skipped_tokens = [token]
+                    for i in range(stack[-1].unicode_skip):
+                        to_skip = tokens.peek()
+                        if to_skip is None or isinstance(to_skip, GroupBoundary):
+                            break
+                        skipped_tokens.append(next(tokens))
+                    combine_text(unichr(ordinal), skipped_tokens)
+                    continue
+                elif token.word == b'uc':
+                    if token.number is None:
+                        report_error(errors, ParseError(token.pos, '\\uc requires argument'))
+                    elif token.number < 0:
+                        report_error(errors, ParseError(token.pos, 'Negative \\uc'))
+                    else:
+                        if max_unicode_skip is not None and token.number > max_unicode_skip:
+                            raise LimitExceeded(token.pos, 'max_unicode_skip', token.number)
+                        stack[-1].unicode_skip = token.number
+                elif token.word in CHARSET_ENCODINGS or token.word == b'ansicpg':
+                    selected = control_word_encoding(token)
+                    if encoding is None and selected is not None:
+                        effective.encoding = selected
+                        decoder = CharDecoder(selected)
+                elif track_formatting and token.word in FORMATTING_WORDS:
+                    if token.word == b'deff':
+                        effective.default_font = token.number
+                    stack[-1].formatting = update_formatting(stack[-1].formatting, token, effective.default_font)
                 stack[-1].group.append(TokenNode(token))
-            else:
-                combine_text(decoded_text, [token])
-        elif isinstance(token, ControlWord):
-            if token.word == b'u':  # unicode text
-                ordinal = token.number
-                if ordinal < 0:
-                    ordinal += 65536
-                skipped_tokens = [token]
-                for i in range(stack[-1].unicode_skip):
-                    to_skip = tokens.peek()
-                    if isinstance(to_skip, GroupBoundary):
-                        break
-                    skipped_tokens.append(next(tokens))
-                combine_text(unichr(ordinal), skipped_tokens)
-                continue
-            elif token.word == b'uc':
-                if token.number is None:
-                    raise ParseError(token.pos, '\\uc requires argument')
-                stack[-1].unicode_skip = token.number
-            elif token.word == b'ansi':
-                set_encoding('ascii')
-            elif token.word == b'pc':
-                set_encoding('cp437')
-            elif token.word == b'pca':
-                set_encoding('cp850')
-            elif token.word == b'ansicpg':
-                if token.number in RTF_ENCODINGS:
-                    set_encoding(RTF_ENCODINGS[token.number])
+            elif isinstance(token, SkippedGroup):
+                stack[-1].group.append(lazy_group(token, effective.encoding, stack[-1].unicode_skip, errors))
+            elif isinstance(token, ControlSymbol):
+                if token.symbol == b'~':
+                    combine_text('\u00a0', [token])
+                elif token.symbol == b'-':
+                    combine_text('\u00ad', [token])
+                elif token.symbol == b'_':
+                    combine_text('\u2011', [token])
                 else:
-                    set_encoding('cp{}'.format(token.number))
-            stack[-1].group.append(TokenNode(token))
-        elif isinstance(token, ControlSymbol):
-            if token.symbol == b'~':
-                combine_text('\u00a0', [token])
-            elif token.symbol == b'-':
-                combine_text('\u00ad', [token])
-            elif token.symbol == b'_':
-                combine_text('\u2011', [token])
+                    stack[-1].group.append(TokenNode(token))
             else:
                 stack[-1].group.append(TokenNode(token))
+
+        trailing = []
+        while isinstance(tokens.peek(), Separator):
+            trailing.append(next(tokens))
+        if not tokens.has_next():
+            break
+        if tokens.peek() == GroupBoundary(opening=False):
+            report_error(errors, ParseError(next(tokens).pos, 'Unbalanced }'))
         else:
-            stack[-1].group.append(TokenNode(token))
+            report_error(errors, ParseError(tokens.peek().pos,
+                                            'Unexpected trailing token {!r}'.format(tokens.peek())))
+        # the root was closed too early, the rest of the tokens continue it
+        for token in trailing:
+            root.append(TokenNode(token))
+        stack.append(root_scope)
+        root_closed = True
+
+    if stack:
+        for undecoded in decoder.flush():
+            stack[-1].group.append(TokenNode(undecoded))
+        if errors is not None:
+            for scope in reversed(stack[1:] if root_closed else stack):
+                errors.append(ParseError(scope.group.pos, 'Unterminated group'))
+    return Document(root, trailing=trailing, encoding=effective.encoding, errors=errors,
+                    default_font=effective.default_font)
+
+
+class Change(object):
+    """A difference between two documents: old nodes of old_parent were replaced by new nodes of new_parent"""
+    def __init__(self, old, new, old_parent=None, new_parent=None):
+        self.old = old
+        self.new = new
+        self.old_parent = old_parent
+        self.new_parent = new_parent
 
-    trailing = []
-    for token in tokens:
-        if isinstance(token, Separator):
-            trailing.append(token)
+    @property
+    def kind(self):
+        if not self.old:
+            return 'insert'
+        elif not self.new:
+            return 'delete'
+        return 'replace'
+
+    def __repr__(self):
+        return 'Change({!r}, old={!r}, new={!r})'.format(self.kind, self.old, self.new)
+
+
+def diff(old, new):
+    """Generates changes between two documents (or groups) using structural hashes.
+
+    Subtrees with equal digests are skipped without descending into them, so the work done is proportional
+    to the size of the changed parts of the tree.
+    """
+    if isinstance(old, Document):
+        old = old.root
+    if isinstance(new, Document):
+        new = new.root
+    if old.digest == new.digest:
+        return
+    if not isinstance(old, Group) or not isinstance(new, Group):
+        yield Change([old], [new])
+        return
+
+    old_digests = [child.digest for child in old.content]
+    new_digests = [child.digest for child in new.content]
+    start = 0
+    while start < len(old_digests) and start < len(new_digests) and old_digests[start] == new_digests[start]:
+        start += 1
+    old_end, new_end = len(old_digests), len(new_digests)
+    while old_end > start and new_end > start and old_digests[old_end - 1] == new_digests[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    matcher = SequenceMatcher(None, old_digests[start:old_end], new_digests[start:new_end], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
             continue
-        raise ParseError(token.pos, 'Unexpected trailing token {!r}'.format(token))
+        old_nodes = old.content[start + i1:start + i2]
+        new_nodes = new.content[start + j1:start + j2]
+        if len(old_nodes) != len(new_nodes):
+            yield Change(old_nodes, new_nodes, old_parent=old, new_parent=new)
+            continue
+        for old_node, new_node in zip(old_nodes, new_nodes):
+            if isinstance(old_node, Group) and isinstance(new_node, Group):
+                for change in diff(old_node, new_node):
+                    yield change
+            else:
+                yield Change([old_node], [new_node], old_parent=old, new_parent=new)
+
+
+SNAPSHOT_MAGIC = b'RTFSNAP'
+# Bump whenever attributes of pickled nodes change:
+# 1: initial format
+# 2: Group.end, Group/Text.formatting, Document.encoding and Document.errors
+# 3: LazyGroup.bulk_hex, snapshot key includes parse options
+# 4: Document.default_font
+SNAPSHOT_VERSION = 4
+SNAPSHOT_HEADER = struct.Struct('>7sH20s')
+
+
+def source_hash(data, encoding=None, bulk_hex=False, lazy_destinations=None):
+    """Hash of the source bytes and the parse options, used as the key of snapshots"""
+    h = sha1(data)
+    options = (encoding, bool(bulk_hex), sorted(lazy_destinations or ()))
+    h.update(b'\0' + repr(options).encode('ascii'))
+    return h.digest()
+
+
+def save_snapshot(document, file, key):
+    """Writes a parsed document as a versioned binary snapshot of the source with the given source_hash"""
+    file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, key))
+    pickle.dump(document, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(file, key=None):
+    """Loads a document saved by save_snapshot.
+
+    Returns None if the snapshot was written by another version of the format, or for another source
+    than the one with source_hash key. Snapshots are pickles, only load snapshots you wrote yourself.
+    """
+    header = file.read(SNAPSHOT_HEADER.size)
+    if len(header) != SNAPSHOT_HEADER.size:
+        return None
+    magic, version, snapshot_key = SNAPSHOT_HEADER.unpack(header)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or (key is not None and key != snapshot_key):
+        return None
+    return pickle.load(file)
+
+
+class SnapshotStore(object):
+    """Directory of document snapshots named by source_hash of their source and parse options"""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, binascii.hexlify(key).decode('ascii') + '.snapshot')
+
+    def load(self, key):
+        """Returns the snapshot with the given key, None if there is none or it cannot be read"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                return load_snapshot(f, key)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # truncated or written by incompatible code (unpickling fails in many ways), parse again
+            remove_file(path)
+            return None
+
+    def save(self, key, document):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                save_snapshot(document, f, key)
+            os.rename(temp_path, path)
+        except:
+            remove_file(temp_path)
+            raise
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    start = 0
+    while start < n:
+        end = min(start + 65536, n)
+        if a[start:end] != b[start:end]:
+            # a[:start] == b[:start] and the first difference is before end
+            while end - start > 1:
+                middle = (start + end) // 2
+                if a[start:middle] == b[start:middle]:
+                    start = middle
+                else:
+                    end = middle
+            return start
+        start = end
+    return n
 
-    return Document(root, trailing=trailing)
 
+def enclosing_group(group, start, end):
+    """Returns the innermost group below group whose braces are outside of the byte range [start, end)"""
+    while True:
+        for child in group.content:
+            if isinstance(child, Group) and child.end is not None and child.pos < start and end <= child.end:
+                break
+        else:
+            return group
+        if isinstance(child, LazyGroup) and not child.materialized:
+            return child
+        group = child
 
-def escape_text_tokens(text, encoding=None):
+
+def index_in_parent(node):
+    for index, child in enumerate(node.parent.content):
+        if child is node:
+            return index
+    raise AssertionError('A node was not found within its parent')
+
+
+def unicode_skip_at(node):
+    """Returns the \\uc value in effect at the start of node"""
+    while node.parent is not None:
+        skip = None
+        for sibling in node.parent.content:
+            if sibling is node:
+                break
+            if (isinstance(sibling, TokenNode) and isinstance(sibling.token, ControlWord) and
+                    sibling.token.word == b'uc'):
+                skip = sibling.token.number
+        if skip is not None:
+            return skip
+        node = node.parent
+    return 1
+
+
+def shift_positions(node, delta):
+    """Moves source positions of the subtree by delta bytes"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Group):
+            if node.pos is not None:
+                node.pos += delta
+            if node.end is not None:
+                node.end += delta
+            if not isinstance(node, LazyGroup) or node.materialized:
+                stack.extend(node.content)
+        elif isinstance(node, TokenNode):
+            if node.token.pos is not None:
+                node.token.pos += delta
+        elif isinstance(node, Text) and node.tokens:
+            for token in node.tokens:
+                if token.pos is not None:
+                    token.pos += delta
+
+
+def parse_group(tokens, encoding, unicode_skip, formatting=None, default_font=None):
+    tokens = PeekIter(tokens)
+    first = tokens.peek()
+    if isinstance(first, SkippedGroup):
+        next(tokens)
+        if tokens.has_next():
+            raise ParseError(tokens.peek().pos, 'Unexpected trailing token {!r}'.format(tokens.peek()))
+        return lazy_group(first, encoding, unicode_skip)
+    return parse(tokens, encoding=encoding, unicode_skip=unicode_skip, track_formatting=formatting is not None,
+                 formatting=formatting, default_font=default_font).root
+
+
+def reparse(document, source, old_source=None, bulk_hex=False, lazy_destinations=None):
+    """Updates a parsed document to a new version of its source, parsing only the groups that changed.
+
+    The byte range differing from old_source (the serialized document by default) is located and the
+    innermost group enclosing it is parsed again from source; if the change does not parse as that
+    single group, enclosing groups are tried up to a full parse. Unchanged nodes are kept, with their
+    positions shifted. Returns the document, which is updated in place.
+    """
+    if old_source is None:
+        old_source = b''.join(bytes(token) for token in flatten(document))
+    start = common_prefix_length(old_source, source)
+    if start == len(old_source) == len(source):
+        return document
+    suffix = min(common_prefix_length(old_source[::-1], source[::-1]), min(len(old_source), len(source)) - start)
+    delta = len(source) - len(old_source)
+
+    group = enclosing_group(document.root, start, len(old_source) - suffix)
+    while group is not document.root:
+        new_end = group.end + delta
+        tokens = tokenize(ByteStream(source[group.pos:new_end + 1], offset=group.pos), bulk_hex=bulk_hex,
+                          lazy_destinations=lazy_destinations)
+        try:
+            new_group = parse_group(tokens, document.encoding, unicode_skip_at(group), group.formatting,
+                                    document.default_font)
+        except ParseError:
+            new_group = None
+        if new_group is not None and new_group.end == new_end:
+            parent = group.parent
+            parent.content[index_in_parent(group)] = new_group
+            new_group.parent = parent
+            parent.invalidate()
+            node = new_group
+            while node.parent is not None:
+                for sibling in node.parent.content[index_in_parent(node) + 1:]:
+                    shift_positions(sibling, delta)
+                node.parent.end += delta
+                node = node.parent
+            for token in document.trailing or ():
+                token.pos += delta
+            return document
+        group = group.parent
+
+    new_document = parse(tokenize(source, bulk_hex=bulk_hex, lazy_destinations=lazy_destinations),
+                         encoding=document.encoding, track_formatting=document.root.formatting is not None,
+                         formatting=document.root.formatting)
+    document.root = new_document.root
+    document.trailing = new_document.trailing
+    document.default_font = new_document.default_font
+    return document
+
+
+def escape_text_tokens(text, encoding=None, unicode_skip=1):
     prevc = None
     for c in text:
         if (c == '\n' and prevc != '\r') or (c == '\r' and prevc != '\n'):
-            yield ControlWord(b'line')
+            yield ControlWord(b'line', trailing=b' ')
         elif (c == '\n' and prevc == '\r') or (c == '\r' and prevc == '\n'):
             pass
         elif c in '\\{}':
@@ -608,21 +1499,24 @@ def escape_text_tokens(text, encoding=None):
         elif c == u('\u2011'): # non-breaking hyphen
             yield ControlSymbol(b'_')
         elif c in 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 :;@/()_-?.,"\'=&%+[]*':
-            yield RawChar(c.encode('ascii'))
+            yield RawChar(ord(c))
         else:
-            encoded = False
+            encoded = None
             if encoding:
                 try:
-                    yield ANSIEscapedChar(c.encode(encoding)[0])
-                    encoded = True
+                    encoded = c.encode(encoding)
                 except UnicodeEncodeError:
                     pass
-            if not encoded:
+            if encoded is not None and (len(encoded) == 1 or is_multibyte(encoding)):
+                for byte in bytearray(encoded):
+                    yield ANSIEscapedChar(byte)
+            else:
                 ordinal = ord(c)
                 if ordinal > 32768:
                     ordinal -= 65536
                 yield ControlWord(b'u', number=ordinal)
-                yield RawChar(b'?')
+                for i in range(unicode_skip):
+                    yield RawChar(ord('?'))
         prevc = c
 
 
@@ -630,11 +1524,311 @@ def escape_text(text, encoding=None):
     return b''.join(bytes(x) for x in escape_text_tokens(text, encoding=encoding))
 
 
+def continues_control_word(token, data):
+    """Whether data written right after the control word token would be read as a part of it"""
+    if token.trailing:
+        return False
+    if data[:1] == b' ':
+        return True
+    if data[:1].isdigit():
+        return True
+    return token.number is None and (data[:1].isalpha() or data[:1] == b'-')
+
+
+def write_tokens(tokens, file, buffer_size=65536):
+    """Writes tokens to a binary file in large writes, returns the number of bytes written.
+
+    A space is put after a control word without a delimiter if the next token would otherwise continue it,
+    which can happen when tokens were created or moved by editing the tree.
+    """
+    parts = []
+    buffered = 0
+    written = 0
+    previous = None
+    for token in tokens:
+        data = bytes(token)
+        if not data:
+            continue
+        if isinstance(previous, ControlWord) and continues_control_word(previous, data):
+            data = b' ' + data
+        previous = token
+        parts.append(data)
+        buffered += len(data)
+        if buffered >= buffer_size:
+            file.write(b''.join(parts))
+            written += buffered
+            parts = []
+            buffered = 0
+    if parts:
+        file.write(b''.join(parts))
+        written += buffered
+    return written
+
+
+def rename_control_words(tokens, mapping):
+    """Renames control words on the fly; mapping keys and values are words or (word, number) pairs,
+    a (word, number) key takes precedence over the word alone"""
+    for token in tokens:
+        if isinstance(token, ControlWord):
+            new = mapping.get((token.word, token.number))
+            if new is None:
+                new = mapping.get(token.word)
+            if new is not None:
+                if isinstance(new, tuple):
+                    word, number = new
+                else:
+                    word, number = new, token.number
+                token = ControlWord(word, number=number, pos=token.pos, trailing=token.trailing)
+        yield token
+
+
+def drop_control_words(tokens, words):
+    """Leaves out control words whose word is in words (e.g. revision ids)"""
+    for token in tokens:
+        if isinstance(token, ControlWord) and token.word in words:
+            continue
+        yield token
+
+
+def drop_groups(tokens, destinations, invisible=False):
+    """Leaves out whole groups of the given destinations (and all \\* groups with invisible), including nested
+    groups.
+
+    Only the tokens up to the destination word are held back, so memory use does not depend on group size.
+    """
+    tokens = PeekIter(tokens)
+    for token in tokens:
+        if not isinstance(token, GroupBoundary) or not token.opening:
+            yield token
+            continue
+        held = [token]
+        while isinstance(tokens.peek(), Separator) or tokens.peek() == ControlSymbol(b'*'):
+            held.append(next(tokens))
+        if ((invisible and len(held) > 1 and held[-1] == ControlSymbol(b'*')) or
+                (isinstance(tokens.peek(), ControlWord) and tokens.peek().word in destinations)):
+            depth = 1
+            for token in tokens:
+                if isinstance(token, GroupBoundary):
+                    depth += 1 if token.opening else -1
+                    if depth == 0:
+                        break
+            continue
+        for token in held:
+            yield token
+
+
+def rewrite(source, file, stages, bulk_hex=True, limits=None):
+    """Tokenizes source, passes the tokens through stages (functions taking and returning a token iterator)
+    and writes them to file without building a Document, returns the number of bytes written"""
+    tokens = tokenize(source, bulk_hex=bulk_hex, limits=limits)
+    for stage in stages:
+        tokens = stage(tokens)
+    return write_tokens(tokens, file)
+
+
+def control_word_encoding(token):
+    """Returns the encoding selected by a character set control word (\\ansicpg etc.), None for other words"""
+    if token.word == b'ansicpg':
+        name = RTF_ENCODINGS.get(token.number, 'cp{}'.format(token.number))
+        try:
+            codecs.lookup(name)
+        except LookupError:
+            return None
+        return name
+    return CHARSET_ENCODINGS.get(token.word)
+
+
+_byte_tables = {}
+
+
+def byte_table(encoding):
+    """Returns a list of 256 strings decoding single bytes in encoding, None for bytes which do not decode"""
+    if encoding not in _byte_tables:
+        table = []
+        for ordinal in range(256):
+            try:
+                table.append(int2byte(ordinal).decode(encoding))
+            except UnicodeDecodeError:
+                table.append(None)
+        _byte_tables[encoding] = table
+    return _byte_tables[encoding]
+
+
+_multibyte = {}
+
+
+def is_multibyte(encoding):
+    """Returns whether some characters of encoding take more than one byte (DBCS code pages, UTF-8)"""
+    if encoding not in _multibyte:
+        table = byte_table(encoding)
+        _multibyte[encoding] = False
+        for ordinal in range(128, 256):
+            if table[ordinal] is not None:
+                continue
+            for trail in (0x40, 0xa1):
+                try:
+                    if len((int2byte(ordinal) + int2byte(trail)).decode(encoding)) == 1:
+                        _multibyte[encoding] = True
+                except UnicodeDecodeError:
+                    pass
+    return _multibyte[encoding]
+
+
+class CharDecoder(object):
+    """Decodes Char tokens of an encoding one at a time.
+
+    Single bytes are looked up in a byte_table; for multi-byte encodings a lead byte is held in an
+    incremental decoder until the rest of its character follows. The tokens of the last character (or of
+    bytes which do not decode) are kept in pending until taken.
+
+    A lead byte followed by an invalid trail byte does not decode on its own; the trail byte is then left
+    in retry, to be decoded again as the possible start of the next character.
+    """
+    def __init__(self, encoding):
+        self.table = byte_table(encoding)
+        self.incremental = codecs.getincrementaldecoder(encoding)() if is_multibyte(encoding) else None
+        self.pending = []
+        self.retry = None
+
+    def decode(self, token):
+        """Returns the decoded character, '' if more bytes are needed and None if the bytes do not decode"""
+        self.pending.append(token)
+        if self.incremental is None or len(self.pending) == 1 and self.table[token.ordinal] is not None:
+            return self.table[token.ordinal]
+        try:
+            return self.incremental.decode(int2byte(token.ordinal))
+        except UnicodeDecodeError:
+            self.incremental.reset()
+            if len(self.pending) > 1:
+                self.retry = self.pending.pop()
+            return None
+
+    def take_retry(self):
+        token = self.retry
+        self.retry = None
+        return token
+
+    def take(self):
+        tokens = self.pending
+        self.pending = []
+        return tokens
+
+    def flush(self):
+        """Forgets an incomplete character and returns its tokens"""
+        if self.incremental is not None:
+            self.incremental.reset()
+        return self.take()
+
+
+# Destinations left out of exported text besides NON_CONTENT_DESTINATIONS and all \* groups
+EXPORT_SKIPPED_DESTINATIONS = NON_CONTENT_DESTINATIONS | {b'pict', b'fldinst', b'nonshppict'}
+
+TEXT_SYMBOLS = {b'~': u('\u00a0'), b'-': u('\u00ad'), b'_': u('\u2011'), b'\\': '\\', b'{': '{', b'}': '}'}
+
+TEXT_WORDS = {b'tab': '\t', b'line': '\n', b'emdash': u('\u2014'), b'endash': u('\u2013'),
+              b'bullet': u('\u2022'), b'lquote': u('\u2018'), b'rquote': u('\u2019'),
+              b'ldblquote': u('\u201c'), b'rdblquote': u('\u201d')}
+
+
+def stream_rows(tokens, encoding=None, unicode_skip=1, paragraphs=True):
+    """Generates document content as lists of strings in a single pass over tokens, without building a tree.
+
+    A table row (\\cell ... \\row) gives the texts of its cells, any other paragraph a list with its text
+    (unless paragraphs is false). Only the current row is kept in memory and tokens are consumed only as far
+    as the rows taken from the generator.
+    """
+    if encoding is None:
+        encoding = 'ascii'
+        detect = True
+    else:
+        detect = False
+    decoder = CharDecoder(encoding)
+    tokens = PeekIter(drop_groups(tokens, EXPORT_SKIPPED_DESTINATIONS, invisible=True))
+    skips = [unicode_skip]
+    in_table = [False]
+    parts = []
+    cells = []
+    for token in tokens:
+        if decoder.pending and not isinstance(token, Char):
+            decoder.flush()
+        if isinstance(token, GroupBoundary):
+            if token.opening:
+                skips.append(skips[-1])
+                in_table.append(in_table[-1])
+            elif len(skips) > 1:
+                skips.pop()
+                in_table.pop()
+        elif isinstance(token, Char):
+            while token is not None:
+                text = decoder.decode(token)
+                if text != '':  # else a lead byte of a multi-byte character
+                    decoder.take()
+                    if text is not None:
+                        parts.append(text)
+                token = decoder.take_retry()
+        elif isinstance(token, ControlWord):
+            word = token.word
+            if word == b'u' and token.number is not None and -32768 <= token.number <= 65535:
+                ordinal = token.number
+                if ordinal < 0:
+                    ordinal += 65536
+                parts.append(unichr(ordinal))
+                for i in range(skips[-1]):
+                    if isinstance(tokens.peek(), (GroupBoundary, type(None))):
+                        break
+                    next(tokens)
+            elif word in TEXT_WORDS:
+                parts.append(TEXT_WORDS[word])
+            elif word == b'par':
+                if in_table[-1]:
+                    parts.append('\n')
+                else:
+                    if paragraphs:
+                        yield [''.join(parts)]
+                    parts = []
+            elif word == b'cell':
+                cells.append(''.join(parts))
+                parts = []
+            elif word == b'row':
+                yield cells
+                cells = []
+            elif word == b'intbl':
+                in_table[-1] = True
+            elif word == b'pard':
+                in_table[-1] = False
+            elif word == b'uc' and token.number is not None and token.number >= 0:
+                skips[-1] = token.number
+            elif detect and control_word_encoding(token) is not None:
+                decoder = CharDecoder(control_word_encoding(token))
+        elif isinstance(token, ControlSymbol) and token.symbol in TEXT_SYMBOLS:
+            parts.append(TEXT_SYMBOLS[token.symbol])
+    if cells:
+        yield cells
+    if parts and paragraphs:
+        yield [''.join(parts)]
+
+
+def export_text(tokens, file, encoding=None):
+    """Writes document content to a text file, one paragraph or table row (cells separated by tabs) per line"""
+    for row in stream_rows(tokens, encoding=encoding):
+        file.write('\t'.join(cell.replace('\n', ' ') for cell in row) + '\n')
+
+
+def export_csv(tokens, file, encoding=None, prefix=()):
+    """Writes document content as CSV, one paragraph or table row per record, each starting with prefix"""
+    writer = csv.writer(file)
+    prefix = list(prefix)
+    for row in stream_rows(tokens, encoding=encoding):
+        writer.writerow(prefix + row)
+
+
 def flatten(node, encoding=None):
-    if isinstance(node, Group):
+    if isinstance(node, LazyGroup) and not node.materialized:
+        yield SkippedGroup(node.raw, node.destination[0].token.word, pos=node.pos, bulk_hex=node.bulk_hex)
+    elif isinstance(node, Group):
         yield GroupBoundary(opening=True)
         for child in node.content:
-            for token in flatten(child):
+            for token in flatten(child, encoding=encoding):
                 yield token
         yield GroupBoundary(opening=False)
     elif isinstance(node, TokenNode):
@@ -646,7 +1840,7 @@ def flatten(node, encoding=None):
         for token in tokens:
             yield token
     elif isinstance(node, Document):
-        for token in flatten(node.root):
+        for token in flatten(node.root, encoding=encoding or node.encoding):
             yield token
         if node.trailing:
             for token in node.trailing:
@@ -670,6 +1864,252 @@ def find_re(root, pattern):
                 yield node, m
 
 
+TEXT_BREAKS = {b'par': '\n', b'line': '\n', b'row': '\n', b'sect': '\n', b'page': '\n', b'cell': '\t',
+               b'tab': '\t'}
+
+
+class TextIndex(object):
+    """Text of all Text nodes below root concatenated into one string, with offsets mapping back to the nodes.
+
+    Paragraph, line and cell breaks are represented by a newline or tab, so that text does not run together
+    across them. With content_only, only the document content is indexed (see document_content): font
+    tables, document info, headers and other non-content or \\* destinations are left out and lazy groups of
+    them are not parsed.
+    """
+    def __init__(self, root, content_only=True):
+        if isinstance(root, Document):
+            root = root.root
+        self.nodes = []
+        self.starts = []
+        parts = []
+        length = 0
+        for node in (document_content(root) if content_only else root.walk()):
+            if isinstance(node, Text):
+                text = node.text
+            elif (isinstance(node, TokenNode) and isinstance(node.token, ControlWord) and
+                    node.token.word in TEXT_BREAKS):
+                text = TEXT_BREAKS[node.token.word]
+            else:
+                continue
+            if text:
+                self.nodes.append(node)
+                self.starts.append(length)
+                parts.append(text)
+                length += len(text)
+        self.text = ''.join(parts)
+
+    def spans(self, start, end):
+        """Returns list of (node, node_start, node_end) for Text nodes covering text[start:end]"""
+        ret = []
+        index = max(bisect_right(self.starts, start) - 1, 0)
+        while index < len(self.nodes):
+            node_start = self.starts[index]
+            if node_start >= end and (ret or node_start > start):
+                break
+            node = self.nodes[index]
+            if isinstance(node, Text):
+                ret.append((node, max(start - node_start, 0), min(end - node_start, len(node.text))))
+            index += 1
+        return ret
+
+
+class SearchMatch(object):
+    def __init__(self, pattern, index, match, spans):
+        self.pattern = pattern
+        self.index = index
+        self.match = match
+        self.spans = spans
+
+    @property
+    def start(self):
+        return self.match.start()
+
+    @property
+    def end(self):
+        return self.match.end()
+
+    @property
+    def text(self):
+        return self.match.group()
+
+    @property
+    def nodes(self):
+        return [node for node, start, end in self.spans]
+
+    @property
+    def pos(self):
+        """Position of the match in the source, None if unknown"""
+        if not self.spans:
+            return None
+        node, start, end = self.spans[0]
+        return node.source_pos(start)
+
+    @property
+    def end_pos(self):
+        if not self.spans:
+            return None
+        node, start, end = self.spans[-1]
+        return node.source_pos(end)
+
+    def __repr__(self):
+        return 'SearchMatch({!r}, text={!r}, pos={!r})'.format(self.pattern, self.text, self.pos)
+
+
+def search(root, patterns, flags=0, content_only=True):
+    """Finds matches of any of the patterns in the text below root, ordered by position.
+
+    Patterns are literal strings or compiled regular expressions (flags are added to their own flags).
+    They are matched against the concatenated text of all Text nodes, so a match can span several nodes.
+    Each pattern is matched on its own, so its groups and inline flags work as usual, and the matches are
+    merged by position: they do not overlap and if several patterns match at the same position, the first
+    one listed wins. Unless content_only is false, only the document content is searched (see TextIndex).
+    """
+    patterns = list(patterns)
+    compiled = []
+    for pattern in patterns:
+        if isinstance(pattern, string_types):
+            compiled.append(re.compile(re.escape(pattern), flags))
+        else:
+            compiled.append(re.compile(pattern.pattern, pattern.flags | flags))
+    index = TextIndex(root, content_only=content_only)
+    text = index.text
+    pending = [regex.search(text) for regex in compiled]
+    while True:
+        candidates = [(m.start(), i) for i, m in enumerate(pending) if m is not None]
+        if not candidates:
+            break
+        pattern_index = min(candidates)[1]
+        m = pending[pattern_index]
+        yield SearchMatch(patterns[pattern_index], pattern_index, m, index.spans(m.start(), m.end()))
+        pos = m.end() if m.end() > m.start() else m.end() + 1
+        for i, other in enumerate(pending):
+            if other is not None and other.start() < pos:
+                pending[i] = compiled[i].search(text, pos) if pos <= len(text) else None
+
+
+def replace(root, replacements, flags=0, encoding=None, content_only=True):
+    """Applies (pattern, replacement) pairs to the text below root in one pass, returns the number of matches
+    replaced.
+
+    Patterns are matched as in search, so a match can span several Text nodes; the replacement goes to the
+    first of them and the matched text is removed from the others (breaks such as \\par are kept).
+    A replacement is a string, a template expanded with the regular expression match, or a function taking
+    the SearchMatch. Only the tokens of changed characters are re-encoded, the rest is written back as read.
+    As in search, only the document content is changed unless content_only is false.
+    """
+    replacements = list(replacements)
+    edits = {}
+    count = 0
+    if encoding is None:
+        encoding = getattr(root, 'encoding', None)
+    for match in search(root, [pattern for pattern, replacement in replacements], flags=flags,
+                        content_only=content_only):
+        replacement = replacements[match.index][1]
+        if callable(replacement):
+            text = replacement(match)
+        elif isinstance(match.pattern, string_types):
+            text = replacement
+        else:
+            text = match.match.expand(replacement)
+        if text == match.text or not match.spans:
+            continue
+        for node, start, end in match.spans:
+            edits.setdefault(id(node), (node, []))[1].append((start, end, text))
+            text = ''
+        count += 1
+    for node, node_edits in edits.values():
+        unicode_skip = unicode_skip_at(node)
+        for start, end, text in sorted(node_edits, key=lambda edit: edit[0], reverse=True):
+            node.splice(start, end, text, encoding=encoding, unicode_skip=unicode_skip)
+    return count
+
+
+PICTURE_FORMATS = {b'emfblip', b'pngblip', b'jpegblip', b'macpict', b'pmmetafile', b'wmetafile', b'dibitmap',
+                   b'wbitmap'}
+
+
+class EmbeddedObject(object):
+    """Picture or OLE object data embedded in the document"""
+    def __init__(self, kind, group, format=None, size=0, pos=None):
+        self.kind = kind
+        self.group = group
+        self.format = format
+        self.size = size
+        self.pos = pos
+
+    def __repr__(self):
+        return 'EmbeddedObject({!r}, format={!r}, size={!r}, pos={!r})'.format(self.kind, self.format, self.size,
+                                                                           self.pos)
+
+
+def embedded_object(group):
+    """Returns EmbeddedObject of a \\pict or \\objdata group, None for other groups.
+
+    Sizes are counted in decoded bytes; the payload is not decoded. Parse with tokenize(..., bulk_hex=True)
+    to avoid the per-digit cost of hexadecimal payload.
+    """
+    destination, invisible = group.destination
+    if destination is None or destination.token.word not in HEX_DESTINATIONS:
+        return None
+    obj = EmbeddedObject(ascii_as_str(destination.token.word), group)
+    digits = 0
+    for child in group.content:
+        if isinstance(child, TokenNode):
+            token = child.token
+            if isinstance(token, HexData):
+                digits += len(token.digits)
+            elif isinstance(token, BinaryData):
+                obj.size += len(token.data)
+            elif isinstance(token, ControlWord) and token.word in PICTURE_FORMATS:
+                obj.format = ascii_as_str(token.word)
+                continue
+            else:
+                continue
+            if obj.pos is None:
+                obj.pos = token.pos
+        elif isinstance(child, Text):
+            digits += sum(1 for c in child.text if c in '0123456789abcdefABCDEF')
+            if obj.pos is None:
+                obj.pos = child.source_pos(0)
+    obj.size += digits // 2
+    return obj
+
+
+EMBEDDED_START = re.compile(b'\\\\(?:pict|objdata)(?![a-zA-Z])')
+
+
+def embedded_objects(root):
+    """Generates EmbeddedObject for each \\pict and \\objdata group below root (see embedded_object).
+
+    Lazy groups not parsed yet are parsed only if their raw bytes contain such a group.
+    """
+    if isinstance(root, Document):
+        root = root.root
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Group):
+            continue
+        if isinstance(node, LazyGroup) and not node.materialized and not EMBEDDED_START.search(node.raw):
+            continue
+        obj = embedded_object(node)
+        if obj is not None:
+            yield obj
+        stack.extend(reversed(node.content))
+
+
+def walk_materialized(node):
+    """Like node.walk(), but does not parse lazy groups and does not descend into them unless already parsed"""
+    if isinstance(node, Document):
+        node = node.root
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, Group) and not (isinstance(node, LazyGroup) and not node.materialized):
+            stack.extend(reversed(node.content))
+
+
 def dfs_rtl(node, include_root=True):
     if include_root:
         yield node
@@ -767,26 +2207,19 @@ def node_range(start_node, end_node):
 
 
 def as_text(nodes):
-    ret = ''
-    for node in nodes:
-        if isinstance(node, Text):
-            ret += node.text
-        elif isinstance(node, Group):
-            ret += as_text(node.content)
-    return ret
+    return ''.join([node.text for node in nodes if isinstance(node, (Text, Group))])
+
+
+def is_content_group(group):
+    """Returns whether the group is part of the document content, i.e. not a non-content or \\* destination"""
+    destination, invisible = group.destination
+    return destination is None or not (destination.token.word in NON_CONTENT_DESTINATIONS or invisible)
 
 
 def document_content(node):
     if isinstance(node, Group):
-        destination, invisible = node.destination
-        if destination is not None:
-            if destination.token.word in (b'colortbl', b'fonttbl', b'stylesheet', b'themedata',
-                                          b'header', b'headerl', b'headerr', b'headerf',
-                                          b'footer', b'footerl', b'footerr', b'footerf',
-                                          b'footnote', b'info', b'mmathPr'):
-                return
-            if invisible:
-                return
+        if not is_content_group(node):
+            return
         for child in node.content:
             for child_node in document_content(child):
                 yield child_node
@@ -794,6 +2227,22 @@ def document_content(node):
         yield node
 
 
+def walk_content(node):
+    """Like document_content, but also yields groups: content groups before their content and the other groups
+    (header, \\* destinations...) without descending into them."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Document):
+            node = node.root
+        elif isinstance(node, Group):
+            yield node
+            if is_content_group(node):
+                stack.extend(reversed(node.content))
+        else:
+            yield node
+
+
 def split_by(nodes, matcher):
     nodes = PeekIter(nodes)
     while nodes.has_next():
@@ -814,14 +2263,37 @@ def split_end_by(nodes, matcher):
 if __name__ == '__main__':
     import sys
     import argparse
+    import io
 
     parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='*', help='input files (default: standard input)')
+    parser.add_argument('--format', choices=('rtf', 'text', 'csv'), default='rtf',
+                        help='rtf: parse and write back the RTF (default), text/csv: export paragraphs and table rows')
+    parser.add_argument('--encoding', default='cp1250')
     args = parser.parse_args()
 
-    bs = ByteStream(sys.stdin.buffer)
-    try:
-        for token in flatten(parse(tokenize(bs), encoding='cp1250')):
-            sys.stdout.buffer.write(bytes(token))
-    except:
-        sys.stderr.write('Current position: {}\n'.format(bs.pos))
-        raise
\ No newline at end of file
+    def inputs():
+        # standard input is not closed, unlike the files
+        if not args.files:
+            yield None, sys.stdin.buffer
+        for path in args.files:
+            with open(path, 'rb') as f:
+                yield path, f
+
+    if args.format == 'rtf':
+        for path, f in inputs():
+            bs = ByteStream(f)
+            try:
+                write_tokens(flatten(parse(tokenize(bs), encoding=args.encoding)), sys.stdout.buffer)
+            except:
+                sys.stderr.write('Current position: {}\n'.format(bs.pos))
+                raise
+    else:
+        out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='' if args.format == 'csv' else None)
+        for path, f in inputs():
+            tokens = tokenize(f, bulk_hex=True)
+            if args.format == 'text':
+                export_text(tokens, out, encoding=args.encoding)
+            else:
+                export_csv(tokens, out, encoding=args.encoding, prefix=[path] if len(args.files) > 1 else [])
+        out.detach()  # flushes, sys.stdout stays usable
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from __future__ import print_function
-from nose.tools import eq_
-from rtf import tokenize, GroupBoundary, ControlWord, parse, Document, Group, Text, TokenNode
+import re
+from io import BytesIO
+from nose.tools import eq_, ok_
+from rtf import tokenize, GroupBoundary, ControlWord, parse, Document, Group, Text, TokenNode, diff, \
+    as_text, search, flatten, embedded_objects, HexData, LAZY_DESTINATIONS, document_content, \
+    SnapshotStore, SNAPSHOT_VERSION, source_hash, reparse, Formatting, replace, write_tokens, rewrite, drop_groups, \
+    drop_control_words, rename_control_words, stream_rows, Limits, LimitExceeded, \
+    escape_text, ParseError
 
 
 def test_tokenize():
@@ -14,7 +20,712 @@ def test_tokenize():
 
 
 def test_parse_text_combine():
-    eq_(parse(tokenize(b'{\\rtf1Hello\u32?world}')), Document(Group([TokenNode(ControlWord(b'rtf', number=1)), Text('Hello world')])))
+    eq_(parse(tokenize(b'{\\rtf1Hello\\u32?world}')), Document(Group([TokenNode(ControlWord(b'rtf', number=1)), Text('Hello world')])))
+
+
+def test_digest():
+    doc = parse(tokenize(b'{\\rtf1{\\b Hello} world}'))
+    eq_(doc.digest, parse(tokenize(b'{\\rtf1 {\\b Hello} world}')).digest)
+    digest = doc.digest
+    doc.root.content[1].content[1].text = 'Bye'
+    assert doc.digest != digest
+    eq_(doc, parse(tokenize(b'{\\rtf1{\\b Bye} world}')))
+    text = Text('Bye')
+    group = Group([TokenNode(ControlWord(b'b')), text])
+    eq_(text.parent, group)
+    digest = group.digest
+    text.text = 'Hello'  # the cached digest of the group is dropped through the parent set by Group()
+    assert group.digest != digest
+    eq_(group, Group([TokenNode(ControlWord(b'b')), Text('Hello')]))
+
+
+def test_diff():
+    old = parse(tokenize(b'{\\rtf1{\\b Hello}{\\i a}{\\i b} world}'))
+    new = parse(tokenize(b'{\\rtf1{\\b Hello}{\\i a}{\\i c} world\\par}'))
+    changes = list(diff(old, new))
+    eq_([change.kind for change in changes], ['replace', 'insert'])
+    eq_(changes[0].old, [Text('b')])
+    eq_(changes[0].new, [Text('c')])
+    eq_(changes[1].new, [TokenNode(ControlWord(b'par'))])
+    eq_(list(diff(old, old)), [])
+
+
+def test_as_text_cache():
+    doc = parse(tokenize(b'{\\rtf1{\\b Hello}{\\i  world}}'))
+    eq_(as_text([doc.root]), 'Hello world')
+    bold = doc.root.content[1]
+    bold.content[1].append('!', [])
+    eq_(doc.root.text, 'Hello! world')
+    bold.append(Text('?', []))
+    eq_(as_text(doc.root.content), 'Hello!? world')
+
+
+def test_search():
+    source = b'{\\rtf1\\ansi\\ansicpg1250 I.1 Vysok\\\'e1 {\\b \\\'9akola}\\par I.2 Fakulta\\par}'
+    doc = parse(tokenize(source))
+    matches = list(search(doc, ['I.2', re.compile(r'Vysok\w+ \w+')]))
+    eq_([(m.index, m.text) for m in matches], [(1, 'Vysoká škola'), (0, 'I.2')])
+    eq_(len(matches[0].nodes), 2)
+    eq_(source[matches[0].pos:matches[0].end_pos], b'Vysok\\\'e1 {\\b \\\'9akola')
+    eq_(source[matches[1].pos:matches[1].end_pos], b'I.2')
+    doc = parse(tokenize(b'{\\rtf1{\\fonttbl{\\f0 Arial;}}{\\info{\\title Arial}}Arial\\par}',
+                         lazy_destinations=LAZY_DESTINATIONS))
+    eq_([m.pos for m in search(doc, ['Arial'])], [49])
+    eq_(doc.root.content[1].materialized, False)
+    eq_(len(list(search(doc, ['Arial'], content_only=False))), 3)
+    doc = parse(tokenize(b'{\\rtf1 Kod 12-12, ab 7-8 AB 3-3\\par}'))
+    eq_([m.text for m in search(doc, [re.compile(r'(\d+)-\1')])], ['12-12', '3-3'])
+    eq_([(m.index, m.text) for m in search(doc, ['ab', re.compile(r'(?i)ab'), re.compile(r'(\d+)-\1')])],
+        [(2, '12-12'), (0, 'ab'), (1, 'AB'), (2, '3-3')])
+    eq_(replace(doc, [(re.compile(r'(\d+)-\1'), r'\1')]), 2)
+    eq_(doc.root.text, 'Kod 12, ab 7-8 AB 3')
+
+
+def test_run_checkers():
+    from ka_autofix import Messages, Checker, HeaderChecker, run_checkers
+
+    class RowCollector(Checker):
+        name = 'rows'
+        wants_rows = True
+        rows = []
+
+        def row(self, cells):
+            self.rows.append(cells)
+
+    doc = parse(tokenize(b'{\\rtf1\\foo{\\fonttbl{\\f0 Arial;}}\\pard\\intbl I.2 Fakulta\\cell FMFI\\cell\\row}'))
+    messages = Messages()
+    timings = {}
+    run_checkers(messages, 'x.rtf', doc, checkers=[HeaderChecker, RowCollector], timings=timings)
+    eq_(RowCollector.rows, [['I.2 Fakulta', 'FMFI']])
+    eq_([message.message for message in messages.messages], ['neocakavane riadiace slova v hlavicke: foo'])
+    eq_(sorted(timings), ['header', 'rows'])
+
+
+def test_profiler_trace():
+    import io
+    import json
+    from ka_autofix import Profiler
+    profiler = Profiler()
+    with profiler.phase('a.rtf', 'tokenize') as counters:
+        counters['tokens'] = 3
+    trace = io.StringIO()
+    profiler.write_trace(trace)
+    event, = json.loads(trace.getvalue())['traceEvents']
+    eq_((event['name'], event['ph'], event['args']['path'], event['args']['tokens']), ('tokenize', 'X', 'a.rtf', 3))
+    assert 'tokens=3' in profiler.summary()
+
+
+def test_embedded_objects():
+    source = b'{\\rtf1{\\*\\shppict{\\pict{\\*\\blipuid 00ff}\\pngblip\\picw10 89504e47\r\n0d0a}}{\\object{\\*\\objdata 0102}}}'
+    tokens = list(tokenize(source, bulk_hex=True))
+    eq_(b''.join(bytes(token) for token in tokens), source)
+    eq_([token.data for token in tokens if isinstance(token, HexData)], [b'\x89PNG\r\n', b'\x01\x02'])
+    for doc in (parse(tokens), parse(tokenize(source))):
+        eq_([(obj.kind, obj.format, obj.size, obj.pos) for obj in embedded_objects(doc)],
+            [('pict', 'pngblip', 6, 56), ('objdata', None, 2, 92)])
+
+    # pictures in lazy groups are found; lazy groups without pictures stay unparsed
+    source = b'{\\rtf1{\\info{\\title x}}{\\header{\\pict\\jpegblip ffd8ff}}text}'
+    doc = parse(tokenize(source, lazy_destinations=LAZY_DESTINATIONS))
+    eq_([(obj.kind, obj.format, obj.size) for obj in embedded_objects(doc)], [('pict', 'jpegblip', 3)])
+    info, header = doc.root.content[1:3]
+    eq_((info.materialized, header.materialized), (False, True))
+
+    from ka_autofix import Messages, EmbeddedChecker, run_checkers, MAX_EMBEDDED_SIZE
+    source = b'{\\rtf1{\\header{\\pict\\pngblip ' + b'00' * (MAX_EMBEDDED_SIZE + 1) + b'}}{\\pict 00}text}'
+    messages = Messages(quiet=True)
+    run_checkers(messages, 'x.rtf', parse(tokenize(source, bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS)),
+                 checkers=[EmbeddedChecker])
+    eq_([m.message for m in messages.messages], ['vlozeny objekt (pngblip) na pozicii 29 ma 2.0 MB'])
+
+
+def test_lazy_destinations():
+    source = (b'{\\rtf1\\ansi\\ansicpg1250{\\fonttbl{\\f0 Arial \\{\\\'e1;}{\\f1\\bin2 }}}}'
+              b'{\\*\\themedata 0102}{\\listtable{\\list{\\leveltext \\\'02\\\'00.;}}}\\pard \\\'9akola\\par}')
+    lazy = parse(tokenize(source, lazy_destinations=LAZY_DESTINATIONS))
+    fonttbl = lazy.root.content[3]
+    eq_(as_text(document_content(lazy.root)), '\u0161kola')
+    assert not fonttbl.materialized
+    assert not lazy.root.content[5].materialized
+    eq_(b''.join(bytes(token) for token in flatten(lazy)), source)
+    eq_(fonttbl.content[1].content[3].text, '\u00e1;')
+    eq_(fonttbl.content[1].content[3].source_pos(0), source.index(b"\\'e1"))
+    eq_(lazy, parse(tokenize(source)))
+
+
+def test_snapshot():
+    import os
+    import pickle
+    import tempfile
+    source = b'{\\rtf1{\\fonttbl{\\f0 Arial;}}\\pard Hello\\par}'
+    with tempfile.TemporaryDirectory() as directory:
+        store = SnapshotStore(directory)
+        key = source_hash(source, lazy_destinations=LAZY_DESTINATIONS)
+        eq_(store.load(key), None)
+        document = parse(tokenize(source, lazy_destinations=LAZY_DESTINATIONS))
+        store.save(key, document)
+        loaded = store.load(key)
+        eq_(loaded, document)
+        eq_(loaded.root.content[2].parent, loaded.root)
+        eq_(b''.join(bytes(token) for token in flatten(loaded)), source)
+        eq_(store.load(source_hash(b'{}')), None)
+        eq_(store.load(source_hash(source, bulk_hex=True)), None)
+        eq_(store.load(source_hash(source)), None)
+        eq_(source_hash(source, lazy_destinations=[b'info', b'fonttbl']),
+            source_hash(source, lazy_destinations={b'fonttbl', b'info'}))
+        with open(store.path(key), 'rb') as f:
+            data = f.read()
+        with open(store.path(key), 'wb') as f:
+            f.write(data[:len(data) // 2])
+        eq_(store.load(key), None)
+        ok_(not os.path.exists(store.path(key)))
+        document.unpicklable = lambda: None
+        try:
+            store.save(key, document)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            pass
+        else:
+            ok_(False)
+        eq_(os.listdir(directory), [])
+
+    # pickled attributes are part of the format; bump SNAPSHOT_VERSION when they change
+    source = b'{\\rtf1{\\info{\\title x}}\\pard\\b Hello\\par}'
+    document = parse(tokenize(source, lazy_destinations=LAZY_DESTINATIONS))
+    shape = {'Document': set(vars(document))}
+    for node in document.root.walk():
+        shape.setdefault(node.__class__.__name__, set()).update(vars(node))
+    eq_((SNAPSHOT_VERSION, shape), (4, {
+        'Document': {'_digest', 'parent', 'root', 'trailing', 'encoding', 'errors', 'default_font'},
+        'Group': {'_digest', 'parent', 'pos', 'end', 'content', 'formatting', '_text'},
+        'LazyGroup': {'_digest', 'parent', 'pos', 'end', '_content', '_destination', 'formatting', '_text', 'raw',
+                      'encoding', 'unicode_skip', 'errors', 'bulk_hex'},
+        'TokenNode': {'_digest', 'parent', 'token'},
+        'Text': {'_digest', 'parent', 'tokens', 'token_starts', 'char_starts', 'formatting', '_text'},
+    }))
+
+
+def test_reparse():
+    old_source = (b'{\\rtf1\\ansi\\ansicpg1250\\uc2{\\fonttbl{\\f0 Arial;}}'
+                  b'{\\trowd\\intbl{A}\\cell{B\\u269\\\'e8\\\'e8}\\cell\\row}{C}\\par}\r\n')
+    new_source = old_source.replace(b'{B', b'{Bb')
+    document = parse(tokenize(old_source, lazy_destinations=LAZY_DESTINATIONS))
+    fonttbl, table, after = document.root.content[4:7]
+    reparse(document, new_source, lazy_destinations=LAZY_DESTINATIONS)
+    assert document.root.content[4] is fonttbl and not fonttbl.materialized
+    eq_(document, parse(tokenize(new_source)))
+    assert document.root.content[5] is table and document.root.content[6] is after
+    eq_(after.pos, new_source.index(b'{C'))
+    eq_(after.content[0].source_pos(0), new_source.index(b'C}'))
+    eq_(document.root.end, len(new_source) - 3)
+    eq_(table.content[4].text, 'Bb\u010d')
+    eq_(b''.join(bytes(token) for token in flatten(document)), new_source)
+    split = new_source.replace(b'{Bb', b'{Bb}{')
+    reparse(document, split)
+    eq_([group.text for group in document.root.content[5].content[4:6]], ['Bb', '\u010d'])
+    eq_(document, parse(tokenize(split)))
+
+
+def test_track_formatting():
+    source = b'{\\rtf1\\deff1{\\b bold \\i both}normal\\plain\\s2{\\f2\\fs30 big}\\pard\\b0 end}'
+    document = parse(tokenize(source), track_formatting=True)
+    texts = [node for node in document.walk() if isinstance(node, Text)]
+    eq_([node.text for node in texts], ['bold ', 'both', 'normal', 'big', 'end'])
+    eq_([(f.bold, f.italic, f.font, f.size, f.style) for f in (node.formatting for node in texts)],
+        [(True, False, 1, 24, 0), (True, True, 1, 24, 0), (False, False, 1, 24, 0), (False, False, 2, 30, 2),
+         (False, False, 1, 24, 0)])
+    assert texts[2].formatting is texts[4].formatting is Formatting(font=1)
+
+    def text_formatting(document):
+        return [(node.text, node.formatting) for node in document.walk() if isinstance(node, Text)]
+
+    source = b'{\\rtf1\\deff3{\\fonttbl{\\f3 Arial;}}{\\plain Hello}\\b x}'
+    document = parse(tokenize(source), track_formatting=True)
+    for source in [source.replace(b'Hello', b'Hellx'), source.replace(b'deff3', b'deff2')]:
+        reparse(document, source)
+        eq_(text_formatting(document), text_formatting(parse(tokenize(source), track_formatting=True)))
+    eq_(text_formatting(document)[1], ('Hello', Formatting(font=2)))
+
+
+def test_replace():
+    source = b'{\\rtf1\\ansi\\ansicpg1250{\\b Sekcia}\\par Vysoka \\u353?kola {\\i A}B\\b C\\b0\\par\r\n}'
+    document = parse(tokenize(source))
+    out = BytesIO()
+    write_tokens(flatten(document), out)
+    eq_(out.getvalue(), source)
+    eq_(replace(document, [('ABC', 'xyz'), (re.compile(r'Vysoka (\w+)'), r'\1 vysoka'), ('Sekcia', 'Oddiel \u0161')]), 3)
+    out = BytesIO()
+    write_tokens(flatten(document), out)
+    eq_(out.getvalue(), b"{\\rtf1\\ansi\\ansicpg1250{\\b Oddiel \\'9a}\\par \\'9akola vysoka {\\i xyz}\\b \\b0\\par\r\n}")
+    source = b'{\\rtf1{\\fonttbl{\\f0 Arial;}}{\\info{\\title Arial}}Arial\\par}'
+    document = parse(tokenize(source, lazy_destinations=LAZY_DESTINATIONS))
+    eq_(replace(document, [('Arial', 'Calibri')]), 1)
+    eq_(b''.join(bytes(token) for token in flatten(document)), source.replace(b'}Arial', b'}Calibri'))
+
+
+def test_rewrite():
+    source = b"{\\rtf1\\fs024 \\'E1\\b-0 x\\bin03 abc\\u-3000?}"
+    out = BytesIO()
+    rewrite(source, out, [])
+    eq_(out.getvalue(), source)
+    source = b'{\\rtf1{\\*\\generator Word;}{\\info{\\author x}}\\insrsid5 Hello\\charrsid7\\f2 A{\\f2\\b B}}'
+    out = BytesIO()
+    rewrite(source, out, [lambda tokens: drop_groups(tokens, {b'generator', b'info'}),
+                          lambda tokens: drop_control_words(tokens, {b'insrsid', b'charrsid'}),
+                          lambda tokens: rename_control_words(tokens, {(b'f', 2): (b'f', 5), b'b': b'i'})])
+    eq_(out.getvalue(), b'{\\rtf1Hello\\f5 A{\\f5\\i B}}')
+
+
+def test_stream_rows():
+    source = (b"{\\rtf1\\ansi\\ansicpg1250{\\fonttbl{\\f0 Arial;}}{\\*\\generator Word;}Nadpis\\tab 1\\par "
+              b"\\trowd\\pard\\intbl Vysok\\'e1\\par \\uc2\\u353\\'9a?kola\\cell {\\b UK}\\cell \\row \\pard \\{x\\}}")
+    eq_(list(stream_rows(tokenize(source))),
+        [['Nadpis\t1'], ['Vysok\u00e1\n\u0161kola', 'UK'], ['{x}']])
+
+
+def test_dbcs_code_pages():
+    source = b"{\\rtf1\\ansi\\ansicpg932 \\'82\\'a0\\'b1{\\'82}\\'82\\'a2\\par}"
+    document = parse(tokenize(source))
+    eq_(document.encoding, 'cp932')
+    eq_([node.text for node in document.root.content if isinstance(node, Text)], ['\u3042\uff71', '\u3044'])
+    eq_(b''.join(bytes(token) for token in flatten(document)), source)
+    eq_(list(stream_rows(tokenize(source))), [['\u3042\uff71\u3044']])
+    eq_(escape_text('\u3042', encoding='cp932'), b"\\'82\\'a0")
+    # a lead byte with an invalid trail byte stays undecoded, the trail byte is decoded on its own
+    source = b"{\\rtf1\\ansi\\ansicpg932 \\'82A\\'82\\'a0\\par}"
+    document = parse(tokenize(source))
+    eq_([node.token.ordinal for node in document.root.content[3:4]], [0x82])
+    eq_(document.root.content[4].text, 'A\u3042')
+    eq_(b''.join(bytes(token) for token in flatten(document)), source)
+    eq_(list(stream_rows(tokenize(source))), [['A\u3042']])
+
+
+def test_fuzzy_cells():
+    from ka_autofix import normalize_cell, edit_distance, FormRow, UserData
+    eq_(normalize_cell(' I.1\xa0 Vysok\xe1 \u0161ko\xadla '), 'I.1 Vysok\xe1 \u0161kola')
+    eq_(normalize_cell('Vysok\xe1 \u0161kola', diacritics=False), 'Vysoka skola')
+    eq_(edit_distance('kitten', 'sitting', 5), 3)
+    eq_(edit_distance('kitten', 'sitting', 2), 3)
+    eq_(edit_distance('', 'abc', 5), 3)
+    row = FormRow('I.1 Vysok\xe1 \u0161kola', UserData)
+    eq_(row.match([['I.1 Vysoka \u0161kola', 'UK']], 0), (True, 1))
+    eq_(row.exact(['I.1 Vysoka \u0161kola', 'UK']), False)
+    eq_(row.match([['I.2 Fakulta', 'UK']], 0), (False, 1))
+    # the section number must match exactly, even within the allowed distance
+    row = FormRow('I.2 Fakulta', UserData)
+    eq_(row.match([['I.2 Fakulty', 'FMFI']], 0), (True, 1))
+    eq_(row.match([['I.3 Fakulta', 'FMFI']], 0), (False, 1))
+
+
+def test_stream_check_stops_early():
+    from ka_autofix import Messages, FailFast, check_formular_sp_stream, triage_formular_sp
+
+    def rows():
+        yield ['I. Z\xe1kladn\xe9 inform\xe1cie']
+        yield ['I.1 Vysok\xe1 \u0161kola', 'UK']
+        yield ['I.3 Fakulta', 'FMFI']
+        raise AssertionError('read past the first problem')
+
+    messages = Messages()
+    eq_(check_formular_sp_stream(messages, 'x.rtf', rows(), form_rows=triage_formular_sp), False)
+    eq_([m.message for m in messages.messages], ['riadok 3 nezodpoveda sablone (I.2)'])
+    messages = Messages()
+    messages.fail_fast = True
+    try:
+        messages.add('chyba')
+    except FailFast:
+        pass
+    else:
+        raise AssertionError('FailFast not raised')
+
+
+def check_limit(source, limit, **kwargs):
+    try:
+        parse(tokenize(source, limits=Limits(**kwargs)), limits=Limits(**kwargs))
+    except LimitExceeded as e:
+        eq_(e.limit, limit)
+    else:
+        raise AssertionError('{} not enforced'.format(limit))
+
+
+def test_limits():
+    check_limit(b'{\\rtf1' + b'{' * 100 + b'}' * 101, 'max_depth', max_depth=50)
+    check_limit(b'{\\rtf1\\bin999999999 x}', 'max_size', max_size=1000)
+    check_limit(b'{\\rtf1 ' + b'x' * 5000 + b'}', 'max_tokens', max_tokens=2000)
+    check_limit(b'{\\rtf1\\uc1000000\\u353 x}', 'max_unicode_skip', max_unicode_skip=8)
+    parse(tokenize(b'{\\rtf1{x}}', limits=Limits(max_depth=2)), limits=Limits(max_depth=2))
+
+
+def test_error_recovery():
+    source = b"{\\rtf1\\uc {\\fonttbl{\\f0 Arial;}}Ab\\'zzc\\par}} d\\bin-3 {\\b e"
+    errors = []
+    document = parse(tokenize(source, lazy_destinations=LAZY_DESTINATIONS, errors=errors), errors=errors)
+    eq_([(e.position, e.description) for e in document.errors],
+        [(6, '\\uc requires argument'), (34, "Malformed \\' escape"), (44, 'Unbalanced }'),
+         (47, 'Negative \\bin'), (54, 'Unterminated group')])
+    eq_(as_text(document_content(document.root)), 'Abzzc de')
+    try:
+        parse(tokenize(source))
+    except ParseError as e:
+        eq_(e.position, 6)
+    else:
+        raise AssertionError('strict parse succeeded')
+    # overlong words and numbers end after 32 characters, the rest is text
+    source = b'{\\' + b'a' * 40 + b' \\fs' + b'1' * 40 + b'}'
+    errors = []
+    tokens = list(tokenize(source, errors=errors))
+    eq_([(e.position, e.description) for e in errors], [(34, 'Too long control word'), (78, 'Too long number')])
+    eq_([(token.word, token.number) for token in tokens if isinstance(token, ControlWord)],
+        [(b'a' * 32, None), (b'fs', int('1' * 32))])
+    eq_(b''.join(bytes(token) for token in tokens), source)
+    eq_(str(ParseError(5, 'Unterminated group')), 'Parse error at position 5: Unterminated group')
+    eq_(str(LimitExceeded(7, 'max_depth', 100)), 'Limit max_depth exceeded at position 7: 100')
+    from ka_autofix import error_text
+    eq_(error_text(LimitExceeded(7, 'max_depth', 100)), 'subor prekrocil limit max_depth (100) na pozicii 7')
+    eq_(error_text(ParseError(5, 'Unterminated group')), 'chyba pri parsovani na pozicii 5: Unterminated group')
+
+
+def test_journal():
+    import os
+    import tempfile
+    from ka_autofix import Journal, Messages, MessageType
+    with tempfile.TemporaryDirectory() as directory:
+        form = os.path.join(directory, 'form.rtf')
+        with open(form, 'wb') as f:
+            f.write(b'{\\rtf1}')
+        journal_path = os.path.join(directory, 'journal.jsonl')
+        journal = Journal(journal_path)
+        messages = Messages()
+        messages.add('chyba', path=form)
+        messages.add('pozor', path=form, type=MessageType.warning)
+        journal.record(form, messages.messages)
+        journal.close()
+        with open(journal_path, 'a') as f:
+            f.write('{"path": "cut sh')  # crashed while writing
+        journal = Journal(journal_path, resume=True)
+        messages = Messages()
+        eq_(journal.replay(messages, form), True)
+        eq_([str(message) for message in messages.messages],
+            ['[ERROR] {}: chyba'.format(form), '[WARNING] {}: pozor'.format(form)])
+        journal.record(form, [])
+        journal.close()
+        with open(form, 'ab') as f:
+            f.write(b' ')
+        journal = Journal(journal_path, resume=True)
+        eq_(journal.replay(Messages(), form), False)
+        journal.close()
+        open(journal_path, 'w').close()
+        journal = Journal(journal_path, resume=True)
+        eq_(journal.replay(Messages(), form), False)
+        journal.record(form, [])
+        journal.close()
+        with open(journal_path) as f:
+            eq_(f.read().count('\n'), 1)
+
+
+def test_message_sinks():
+    import io
+    import json
+    from ka_autofix import Messages, MessageType, JsonlSink, Aggregator
+    out = io.StringIO()
+    aggregator = Aggregator(max_groups=2, max_paths=1)
+    messages = Messages(sinks=[JsonlSink(out), aggregator], keep=False, quiet=True)
+    messages.add('chyba riadok sablony (I.1)', path='a.rtf')
+    messages.add('chyba riadok sablony (I.1)', path='b.rtf')
+    messages.progress('a.rtf', 'OK')
+    eq_([m.path for m in messages.flush()], ['a.rtf', 'b.rtf'])
+    messages.add('nazov formulara SP nevyhovuje formatu', path='c.rtf', type=MessageType.warning)
+    messages.add('ina chyba', path='c.rtf')
+    eq_(messages.messages, [])
+    eq_([json.loads(line) for line in out.getvalue().splitlines()][1:3],
+        [{'message': 'chyba riadok sablony (I.1)', 'path': 'b.rtf', 'type': 'error'},
+         {'path': 'a.rtf', 'progress': 'OK'}])
+    eq_(aggregator.summary().splitlines(),
+        ['[ERROR] 2x chyba riadok sablony (I.1) (a.rtf, ...)',
+         '[WARNING] 1x nazov formulara SP nevyhovuje formatu (c.rtf)', '+ 1 dalsich sprav'])
+
+    from ka_autofix import process_generic_file
+    messages = Messages(quiet=True)
+    process_generic_file(messages, 'zly subor?.pdf')
+    eq_((len(messages.messages), messages.recent), (1, []))  # flushed after each file
+
+
+def test_prefetcher():
+    import os
+    import tempfile
+    from contextlib import closing
+    from ka_autofix import Prefetcher
+    with tempfile.TemporaryDirectory() as directory, closing(Prefetcher(workers=2, budget=10)) as prefetcher:
+        paths = []
+        for i, content in enumerate([b'{\\rtf1 a}', b'{\\rtf1 bb}', b'{\\rtf1 ' + b'c' * 20 + b'}']):
+            paths.append(os.path.join(directory, '{}.rtf'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(content)
+        prefetcher.schedule(paths + [os.path.join(directory, 'missing.rtf')])
+        with prefetcher.condition:
+            # the first two files do not fit into the budget together, one of them waits
+            prefetcher.condition.wait_for(lambda: not prefetcher.queue and prefetcher.loading <= prefetcher.waiting)
+            eq_((len(prefetcher.data), len(prefetcher.waiting)), (1, 1))
+            ok_(prefetcher.held <= prefetcher.budget)
+        for path, content in zip(paths, [b'{\\rtf1 a}', b'{\\rtf1 bb}']):
+            with prefetcher.open(path) as f:  # the waiting one is read when opened
+                eq_(f.read(), content)
+        with prefetcher.open(paths[2]) as f:  # over the budget, read when opened
+            eq_(len(f.read()), 28)
+        ok_(prefetcher.held <= prefetcher.budget)
+        prefetcher.release(paths)
+        eq_((prefetcher.held, prefetcher.data), (0, {}))
+
+
+def test_shards():
+    import os
+    import tempfile
+    from ka_autofix import Messages, Options, ShardResultSink, merge_shard_results, process_path
+    with tempfile.TemporaryDirectory() as directory:
+        root = os.path.join(directory, '3a_SP_ziadosti')
+        names = ['SP_{}_Bc_program{}'.format(i, i) for i in range(8)]
+        for name in names:
+            os.makedirs(os.path.join(root, name))
+        with open(os.path.join(root, 'subor.txt'), 'w') as f:
+            f.write('x')
+        results = []
+        for index in range(3):
+            result = os.path.join(directory, 'shard{}.jsonl'.format(index))
+            with open(result, 'w', encoding='utf-8') as f:
+                sink = ShardResultSink(f, (index, 3), root)
+                process_path(Messages(sinks=[sink], keep=False, quiet=True), root, 'sp_list',
+                             options=Options(shard=(index, 3)))
+                sink.complete()
+            results.append(result)
+        messages = Messages(quiet=True)
+        process_path(messages, root, 'sp_list')
+        merged, problems = merge_shard_results(results)
+        eq_(problems, [])
+        eq_([str(message) for message in merged.messages],
+            sorted((str(message) for message in messages.messages), key=lambda line: line.split(': ')[0]))
+        eq_(len(merged.messages), 8 * 3 + 1)
+        eq_(merge_shard_results(results[1:])[1], ['chyba vysledok shardu 0/3'])
+        other = os.path.join(directory, 'other.jsonl')
+        with open(other, 'w', encoding='utf-8') as f:
+            sink = ShardResultSink(f, (0, 3), directory)
+            sink.complete()
+        eq_(merge_shard_results([other] + results[1:])[1],
+            ['vysledky su z behov pre rozne adresare ({}, {})'.format(*sorted([directory, root]))])
+
+
+def test_cross_document_checks():
+    from ka_autofix import Messages, sp_form_keys, il_form_keys, vpch_form_keys, check_sp_dir_consistency
+    sp = sp_form_keys('sp.rtf', [
+        ['I.5 N\xe1zov \u0161tudijn\xe9ho programu', 'Aplikovan\xe1 informatika'],
+        ['N\xe1zov predmetu', 'Priezvisko a meno', 'Funkcia', 'Kvalifik\xe1cia', 'Pracovn\xfd \xfav\xe4zok',
+         'Typ vzdel\xe1vacej \u010dinnosti', 'Jadro \u0160O\xe1no/nie'],
+        ['1.', 'Algebra', 'doc. RNDr. J\xe1n Nov\xe1k, PhD.', 'docent', '', '', '', ''],
+        ['2.', 'Anal\xfdza', 'Mgr. Peter Mal\xfd', 'odborn\xfd asistent', '', '', '', ''],
+        ['3.', 'Algebra', 'prof. Eva Vesel\xe1', 'profesor', '', '', '', ''],
+    ])
+    eq_(sorted(sp.teachers[key] for key in sp.required), ['doc. RNDr. J\xe1n Nov\xe1k, PhD.', 'prof. Eva Vesel\xe1'])
+    il = [il_form_keys('il1.rtf', [['N\xe1zov predmetu:', 'algebra']]), il_form_keys('il2.rtf', [['N\xe1zov predmetu: Fyzika']])]
+    vpch = [vpch_form_keys('vpch.rtf', [['Priezvisko', 'Nov\xe1k'], ['Meno', 'J\xe1n']])]
+    messages = Messages()
+    check_sp_dir_consistency(messages, 'dir', 'SP_1_Bc_aplikovana-informatika', sp, il, vpch)
+    eq_([(m.path, m.message) for m in messages.messages],
+        [('sp.rtf', 'predmet Anal\xfdza nema informacny list'), ('il2.rtf', 'predmet Fyzika sa v SP nenachadza'),
+         ('sp.rtf', 'ucitel prof. Eva Vesel\xe1 nema VPCH')])
+    messages = Messages()
+    check_sp_dir_consistency(messages, 'dir', 'SP_1_Bc_fyzika', sp, il[:1], vpch)
+    eq_(messages.messages[0].message, 'nazov studijneho programu (Aplikovan\xe1 informatika) nesuhlasi s nazvom adresara')
+
+    from ka_autofix import SPKeysChecker, run_checkers
+    source = b"{\\rtf1\\ansi\\ansicpg1250 I.5 N\\'e1zov\\cell Fyzika\\cell\\row}"
+    checker, = run_checkers(Messages(), 'sp.rtf', parse(tokenize(source)), checkers=[SPKeysChecker])
+    eq_(checker.keys.program, 'Fyzika')
+
+
+def test_full_text_index():
+    import os
+    import tempfile
+    from ka_index import Index
+    with tempfile.TemporaryDirectory() as directory:
+        forms = os.path.join(directory, 'forms')
+        os.mkdir(forms)
+        with open(os.path.join(forms, 'a.rtf'), 'wb') as f:
+            f.write(b"{\\rtf1\\ansi\\ansicpg1250 doc. J\\'e1n Nov\\'e1k\\cell Algebra a geometria\\par}")
+        with open(os.path.join(forms, 'b.rtf'), 'wb') as f:
+            f.write(b"{\\rtf1 Geometria\\par Algebra\\par \\'e8esky\\par}")  # cp1250 without \ansicpg
+        index = Index(os.path.join(directory, 'index.db'))
+        eq_(index.update(forms), (2, 0, 0, 0))
+        eq_([(os.path.basename(hit.path), hit.snippets) for hit in index.search(['novak'])],
+            [('a.rtf', ['doc. J\xe1n Nov\xe1k'])])
+        eq_([os.path.basename(hit.path) for hit in index.search(['algebra'])], ['a.rtf', 'b.rtf'])
+        eq_([os.path.basename(hit.path) for hit in index.search(['algebra a geometria'])], ['a.rtf'])
+        eq_(index.search(['novak algebra']), [])  # phrases do not cross cells
+        eq_([hit.snippets for hit in index.search(['cesky'])], [['\u010desky']])
+        try:
+            with index.transaction():
+                index.term_id('nove', create=True)
+                raise ValueError()
+        except ValueError:
+            pass
+        eq_(index.term_id('nove'), None)
+        os.remove(os.path.join(forms, 'b.rtf'))
+        eq_(index.update(forms), (0, 1, 0, 1))
+        eq_([os.path.basename(hit.path) for hit in index.search(['geometria'])], ['a.rtf'])
+        index.close()
+
+
+FUZZ_WORDS = [b'par', b'b', b'i', b'f', b'fs', b'cell', b'row', b'intbl', b'pard', b'plain', b'tab', b'line',
+              b'trowd', b'cellx', b'emdash', b'rsid', b'lang']
+FUZZ_DESTINATIONS = [b'fonttbl', b'generator', b'info', b'pict', b'fldinst', b'xmlnstbl', b'unknowndest']
+
+
+def random_rtf(rng, depth=0):
+    """Returns random valid RTF exercising the tokenizer and parser, including spellings which must survive
+    a round trip byte for byte"""
+    parts = []
+    for i in range(rng.randint(0, 12)):
+        kind = rng.randint(0, 13)
+        if kind == 0 and depth < 6:
+            parts.append(b'{' + random_rtf(rng, depth + 1) + b'}')
+        elif kind == 1 and depth < 6:
+            destination = rng.choice(FUZZ_DESTINATIONS)
+            if destination == b'pict':
+                payload = b'\\pngblip ' + b''.join(rng.choice([b'0a', b'FF', b'\r\n', b' ', b'7c']) for j in
+                                                   range(rng.randint(0, 20)))
+            else:
+                payload = random_rtf(rng, depth + 1)
+            parts.append(b'{' + rng.choice([b'', b'\\*']) + b'\\' + destination + b' ' + payload + b'}')
+        elif kind == 2:
+            number = rng.choice([b'', b'0', b'12', b'-3', b'007', b'-0', b'65535'])
+            trailing = rng.choice([b'', b' ']) if number else b' '
+            parts.append(b'\\' + rng.choice(FUZZ_WORDS) + number + trailing)
+        elif kind == 3:
+            parts.append(b'\\' + rng.choice([b'~', b'-', b'_', b'{', b'}', b'\\', b'|', b':']))
+        elif kind == 4:
+            parts.append(b"\\'" + rng.choice([b'e1', b'9A', b'Fd', b'82', b'a0', b'00']))
+        elif kind == 5:
+            parts.append(b'\\u' + rng.choice([b'353', b'-4064', b'269', b'32']) + rng.choice([b'?', b' ?', b"\\'9a"]))
+        elif kind == 6:
+            parts.append(b'\\uc' + rng.choice([b'0', b'1', b'2']) + b' ')
+        elif kind == 7:
+            data = bytes(rng.randint(0, 255) for j in range(rng.randint(0, 6)))
+            delimiter = b' ' if data[:1].isdigit() or data[:1] in (b' ', b'-') else rng.choice([b'', b' '])
+            parts.append(b'\\bin' + str(len(data)).encode('ascii') + delimiter + data)
+        elif kind == 8:
+            parts.append(rng.choice([b'\r\n', b'\n', b'\r', b'\n\r']))
+        elif kind == 9:
+            parts.append(b'\\ansicpg' + rng.choice([b'1250', b'1252', b'932', b'936']) + b' ')
+        else:
+            parts.append(bytes(rng.choice(b'abc XYZ 019;:?.\xe1\x9a\x82\xa0') for j in range(rng.randint(1, 8))))
+    return b''.join(parts)
+
+
+def random_document(rng):
+    return b'{\\rtf1\\ansi' + random_rtf(rng) + b'}' + rng.choice([b'', b'\r\n', b'\n'])
+
+
+def mutate(rng, source):
+    """Breaks RTF by inserting, deleting or truncating at random places"""
+    source = bytearray(source)
+    for i in range(rng.randint(1, 4)):
+        position = rng.randint(0, len(source))
+        action = rng.randint(0, 3)
+        if action == 0:
+            source[position:position] = rng.choice([b'{', b'}', b"\\'", b'\\', b'\\uc', b'\\bin-2', b'\\-',
+                                                    b'\\' + b'x' * 40, b"\\'g", b'\\u'])
+        elif action == 1:
+            del source[position:position + rng.randint(1, 5)]
+        elif action == 2:
+            del source[position:]
+        else:
+            source[position:position] = bytearray(rng.randint(0, 255) for j in range(3))
+    return bytes(source)
+
+
+def token_key(token):
+    return type(token).__name__, bytes(token), token.pos
+
+
+def fuzz_sources(count, seed=2014):
+    import random
+    rng = random.Random(seed)
+    for i in range(count):
+        yield random_document(rng)
+
+
+def test_fuzz_round_trip():
+    for source in fuzz_sources(300):
+        for lazy in (None, LAZY_DESTINATIONS):
+            document = parse(tokenize(source, bulk_hex=lazy is not None, lazy_destinations=lazy))
+            eq_(b''.join(bytes(token) for token in flatten(document)), source)
+
+
+def test_fuzz_engines_agree():
+    from rtf import ByteStream
+    for source in fuzz_sources(200, seed=7):
+        expected = [token_key(token) for token in tokenize(source)]
+        for buffer_size in (1, 3, 64):
+            eq_([token_key(token) for token in tokenize(ByteStream(BytesIO(source), buffer_size=buffer_size))],
+                expected)
+        # bulk hex and lazily skipped groups only change how the same bytes are split into tokens
+        for lazy in (None, LAZY_DESTINATIONS):
+            tokens = list(tokenize(ByteStream(BytesIO(source), buffer_size=5), bulk_hex=True,
+                                   lazy_destinations=lazy))
+            eq_(b''.join(bytes(token) for token in tokens), source)
+        out = BytesIO()
+        write_tokens(tokenize(source), out, buffer_size=16)
+        eq_(out.getvalue(), source)
+
+
+def test_fuzz_malformed():
+    import random
+    rng = random.Random(46)
+    for source in fuzz_sources(300, seed=11):
+        broken = mutate(rng, source)
+        try:
+            parse(tokenize(broken, lazy_destinations=LAZY_DESTINATIONS))
+        except ParseError:
+            pass
+        errors = []
+        document = parse(tokenize(broken, lazy_destinations=LAZY_DESTINATIONS, errors=errors), errors=errors)
+        for node in document.walk():
+            pass
+        list(stream_rows(tokenize(broken, errors=[])))
+
+
+def test_throughput():
+    """Fails if tokenizing and parsing gets slower than a recorded baseline by more than a tolerance.
+
+    The baseline (MB/s) is machine specific, so it is only checked if RTF_THROUGHPUT_BASELINE names a JSON
+    file; the first run records it. RTF_THROUGHPUT_TOLERANCE is the allowed slowdown (default 0.2).
+    """
+    import gc
+    import json
+    import os
+    import time
+    from unittest import SkipTest
+    path = os.environ.get('RTF_THROUGHPUT_BASELINE')
+    if not path:
+        raise SkipTest('RTF_THROUGHPUT_BASELINE not set')
+    source = b'{\\rtf1\\ansi\\ansicpg1250' + b''.join(fuzz_sources(400, seed=1)) + b'}'
+    best = None
+    gc.disable()
+    try:
+        for i in range(7):
+            start = time.process_time()
+            parse(tokenize(source, bulk_hex=True, lazy_destinations=LAZY_DESTINATIONS), encoding='cp1250')
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    throughput = len(source) / best / 1e6
+    if not os.path.exists(path):
+        with open(path, 'w') as f:
+            json.dump({'parse': throughput}, f)
+        return
+    with open(path) as f:
+        baseline = json.load(f)['parse']
+    tolerance = float(os.environ.get('RTF_THROUGHPUT_TOLERANCE', '0.2'))
+    if throughput < baseline * (1 - tolerance):
+        raise AssertionError('parsing at {:.2f} MB/s, baseline {:.2f} MB/s'.format(throughput, baseline))
 
 
 if __name__ == "__main__":